@@ -1,12 +1,27 @@
 import os
+import argparse
 import configparser
+import gzip
+import contextlib
+import contextvars
+import cProfile
+import io
+import itertools
 import openai
 import discord
 import asyncio
+import collections
+import multiprocessing
+import time
 import tiktoken
 import json
+import logging
 import pathlib
+import pstats
 import re
+import signal
+import tempfile
+import threading
 import traceback
 from functools import wraps
 from discord.ext import commands
@@ -16,7 +31,8 @@ from discord.ext.commands import Converter, BadArgument
 config = configparser.ConfigParser()
 config_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.ini")
 config.read(config_file_path)
-openai.api_key = config.get("API_KEYS", "OPENAI_API_KEY")
+openai.api_key = config.get("API_KEYS", "OPENAI_API_KEY", fallback=None)
+metrics_port = config.getint("METRICS", "PORT", fallback=0)
 
 # Set up OpenAI bot prompts. There are two different types of OpenAI API call: One to get a chat response for the user and one to autogenerate a progress summary to track the campaign over the long term. 
 chatbot_name = {}
@@ -34,16 +50,32 @@ max_user_prompt = 500
 max_progress_summary = 2500
 max_chat_history = 1000
 
+# In the stable prompt layout, chat history is dropped from the front this many entries at a time, so the start of the prompt only shifts every few turns.
+chat_history_trim_chunk = 8
+
 # Set global variables
 summary_priming_prompt = {}
 priming_prompt_base = {}
 DATA_FILE = f"data.json"
+SAVE_DATA_DIRECTORY = pathlib.Path(__file__).parent / "save_data"
+WARM_SNAPSHOT_MAX_AGE = 60 * 60 * 24  # Channels active in the last day are kept warm across restarts.
+SHUTDOWN_TIMEOUT = 60  # Overall deadline for graceful_shutdown to drain turns and outbound messages.
+SHUTDOWN_KILL_GRACE = 30  # Extra time the supervisor allows for the final save and disconnect before killing a worker.
+warm_snapshot_name = "warm_snapshot.json"
+dirty_channels = set()
+last_active = {}
+in_flight_turns = set()
+shutting_down = False
 temperature = {}
 campaign_overview = {}
 progress_summary = {}
 characters = {}
 chat_history = {}
 input_tokens = {}
+token_counts = {}
+prompt_layout = {}
+last_prompt_text = {}
+prefix_overlaps = collections.deque(maxlen=1000)
 
 help_message = '''
     Commands:
@@ -63,7 +95,15 @@ help_message = '''
     !dm [message] - Chat with the bot, including your character's details.
     !update_priming_prompt [new_priming_prompt] - Update the priming prompt for the DM.
     !update_temperature [new_temperature] - Update the chatbot's response temperature. Provide a value between 0 and 1.
-    !display_progress_summary - Shows the DM's automatically generated list of key events.
+    !update_prompt_layout [stable/classic] - Stable (the default) orders the prompt so consecutive requests share a long prefix, which makes them cheaper and faster with prompt caching. Classic is the original layout.
+    !display_progress_summary [page] - Shows a page of the DM's automatically generated list of key events. Starts from page 1.
+    !history [page] - Shows a page of this channel's chat history. Starts from the newest page.
+    !export_campaign - Sends the whole campaign (overview, party, progress and chat history) as a compressed text file.
+    !rules [name] - Look up a 5e SRD spell, condition, monster or item.
+    !update_rules_injection [on/off] - Pass the SRD text of any spell, condition, monster or item named in a !dm message to the DM.
+    !queue_stats - Show outbound message counts, rate limit hits and send latency.
+    !stats - (Admins) Show per-stage latency, token counts and message stats.
+    !profile [start/stop] [sample_every] - (Admins) Profile 1 in every N OpenAI calls with cProfile, and show the results on stop.
     
     Usage example:
     !create_character John Doe, Human, Wizard, Acolyte, chaotic evil, Hates cheese. Loves cats.
@@ -82,17 +122,94 @@ help_message = '''
     !dm What should I do in the next dungeon?
     !update_priming_prompt You are DM, a Dungeons and Dragons dungeon master. You speak like a wise sage and your language is sprinkled with archaic old English. Your campaigns are in the style of a bestselling fantasy author. You adhere fastidiously to the Fifth Edition (5e) of the Dungeons and Dragons ruleset. You are running a Dungeons and Dragons campaign. Here are details to help you run the campaign:
     !update_temperature 0.6
+    !rules grappled
+    !update_rules_injection on
         '''
 # Set up the Discord bot
 intents = discord.Intents.default()
 intents.message_content = True
 intents.typing = False
 intents.presences = False
-bot = commands.Bot(command_prefix="!", intents=intents, case_insensitive=True)
+# AutoShardedBot lets a worker process connect only the shards it has been given (see run_worker). Run as a single process it behaves like a normal bot.
+bot = commands.AutoShardedBot(command_prefix="!", intents=intents, case_insensitive=True)
 
 # Set up the tiktoken tokenizer for counting tokens
 encoding = tiktoken.get_encoding("cl100k_base")
 
+# Anything with the same call signature as openai.ChatCompletion.create can stand in here, e.g. the fake backend in benchmark.py.
+completion_backend = openai.ChatCompletion.create
+
+# Wall clock and CPU seconds spent in each stage of a turn, as {stage: [count, wall, cpu]}. cpu is None for stages timed as wall clock only.
+stage_totals = {}
+stage_totals_lock = threading.Lock()
+
+# The most recent wall clock times for each stage, for the latency histograms in !stats and the metrics endpoint.
+STAGE_LATENCY_WINDOW = 1000
+STAGE_LATENCY_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 1, 2.5, 5, 10, 30)
+stage_latencies = {}
+
+# Stage timings for the turn currently being handled. asyncio.to_thread copies the context, so stages timed in the API thread land here too.
+current_turn_spans = contextvars.ContextVar("current_turn_spans", default=None)
+
+@contextlib.contextmanager
+def timed_stage(stage, cpu=True):
+
+    # CPU time comes from time.thread_time(), so it is only meaningful for synchronous sections. Stages that await (like turn and
+    # progress_summary) must pass cpu=False, or they would pick up whatever other coroutines ran on the event loop thread meanwhile.
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time() if cpu else None
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        with stage_totals_lock:
+            totals = stage_totals.setdefault(stage, [0, 0.0, 0.0 if cpu else None])
+            totals[0] += 1
+            totals[1] += wall
+            if cpu:
+                totals[2] += time.thread_time() - cpu_start
+            stage_latencies.setdefault(stage, collections.deque(maxlen=STAGE_LATENCY_WINDOW)).append(wall)
+        spans = current_turn_spans.get()
+        if spans is not None:
+            spans[f"{stage}_ms"] = round(spans.get(f"{stage}_ms", 0) + wall * 1000, 2)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Sampled cProfile captures, switched on and off with !profile. Only one thread can run a profiler at a time, so a sampled call is skipped if another is already being profiled.
+PROFILE_DIRECTORY = pathlib.Path(__file__).parent / "profiles"
+profile_sample_every = 0
+profile_calls_seen = itertools.count(1)
+profile_samples = 0
+profile_stats = None
+profile_lock = threading.Lock()
+
+def maybe_profiled(function):
+
+    #Runs in the API worker threads, so profile_sample_every is read once in case !profile stop sets it to 0 part way through.
+    #next() on an itertools.count is atomic, so concurrent calls can't lose a count and throw the sample rate off.
+    global profile_samples, profile_stats
+    sample_every = profile_sample_every
+    if not sample_every:
+        return function()
+    if next(profile_calls_seen) % sample_every or not profile_lock.acquire(blocking=False):
+        return function()
+    try:
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function)
+        finally:
+            if profile_stats is None:
+                profile_stats = pstats.Stats(profiler)
+            else:
+                profile_stats.add(profiler)
+            profile_samples += 1
+    finally:
+        profile_lock.release()
+
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
 
     # Returns the number of tokens in a text string.
@@ -112,6 +229,18 @@ def truncate_chat_history(chat_history_list, max_tokens):
         chat_history_tokens = num_tokens_from_string(chat_history_str, "cl100k_base")
     return truncated_chat_history
 
+def truncate_chat_history_chunked(chat_history_list, max_tokens, chunk_size=chat_history_trim_chunk):
+
+    # Like truncate_chat_history, but drops whole chunks of entries from the front. Entries are only tokenized once.
+    entry_tokens = [num_tokens_from_string(f"{entry['role']}: {entry['content']}", "cl100k_base") for entry in chat_history_list]
+    chat_history_tokens = sum(entry_tokens)
+    start = 0
+    while chat_history_tokens > max_tokens and start < len(chat_history_list):
+        end = min(start + chunk_size, len(chat_history_list))
+        chat_history_tokens -= sum(entry_tokens[start:end])
+        start = end
+    return list(chat_history_list[start:])
+
 def truncate_progress_summary(progress_summary_list, max_tokens):
 
     # Count the tokens in the progress_summary and truncate if necessary.
@@ -194,16 +323,166 @@ class Character:
         )
         return character_info
 
-async def send_split_message(ctx, message):
-    
-    #Splits messages when they're too long for Discord.
-    try:
-        message_parts = [message[i:i + 2000] for i in range(0, len(message), 2000)]
-        for part in message_parts:
-            await ctx.send(part)
-    except Exception as e:
-        print(f"Error in send_split_message: {e}")
-        traceback.print_exc()
+    def sheet_fields(self):
+        return {
+            "Name": str(self.name),
+            "Race": str(self.race),
+            "Class": str(self.character_class),
+            "Background": str(self.background),
+            "Alignment": str(self.alignment),
+            "Level": str(self.level),
+            "XP": str(self.xp),
+            "Armor Class": str(self.armor_class),
+            "Hit Points": str(self.hit_points),
+            "Stats": ', '.join(f"{key}: {value}" for key, value in self.stats.items()),
+            "Inventory": ', '.join(self.inventory),
+            "Spells": ', '.join(self.spells),
+            "Notes": str(self.notes),
+        }
+
+    def sheet_diff(self, before):
+        #Only the lines of the character sheet that changed since sheet_fields() was called, so update commands don't echo the whole sheet.
+        changes = [
+            f"{field}: {before.get(field) or '-'} -> {value or '-'}"
+            for field, value in self.sheet_fields().items()
+            if before.get(field) != value
+        ]
+        return "\n".join(changes) if changes else "No changes."
+
+def split_message(message, max_length=2000):
+
+    #Splits messages when they're too long for Discord, preferring paragraph breaks, then line breaks, then sentence ends, then spaces.
+    message_parts = []
+    while len(message) > max_length:
+        window = message[:max_length]
+        cut = max_length
+        for separator in ("\n\n", "\n", ". ", "! ", "? ", " "):
+            index = window.rfind(separator)
+            if index > max_length // 2:
+                cut = index + len(separator)
+                break
+        message_parts.append(message[:cut].rstrip())
+        message = message[cut:].lstrip()
+    message_parts.append(message)
+    return [part for part in message_parts if part.strip()]
+
+class OutboundQueue:
+
+    #Per-channel outbound message queue. Each channel gets its own worker and rate-limit bucket, so a busy channel never holds up the others.
+    #Acknowledgements that pile up while a channel is waiting on its bucket are merged into a single message.
+    def __init__(self, rate=5, per=5.0, max_length=2000, max_retries=5):
+        self.rate = rate
+        self.per = per
+        self.max_length = max_length
+        self.max_retries = max_retries
+        self.pending = {}
+        self.workers = {}
+        self.buckets = {}
+        self.send_latencies = collections.deque(maxlen=1000)
+        self.messages_sent = 0
+        self.rate_limited = 0
+
+    def enqueue(self, ctx, message, ack=False, file=None):
+        channel_id = ctx.channel.id
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel_id, collections.deque()).append((ctx, message, ack and file is None, time.monotonic(), future, file))
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self.drain(channel_id))
+        return future
+
+    async def drain(self, channel_id):
+        pending = self.pending[channel_id]
+        try:
+            while pending:
+                ctx, message, ack, queued_at, future, file = pending.popleft()
+                futures = [future]
+                while ack and pending and pending[0][2] and len(message) + len(pending[0][1]) < self.max_length:
+                    _, next_message, _, _, next_future, _ = pending.popleft()
+                    message = f"{message}\n{next_message}"
+                    futures.append(next_future)
+
+                delivered = True
+                try:
+                    message_parts = split_message(message, self.max_length)
+                    for index, part in enumerate(message_parts):
+                        # Attachments go out with the last part of the message.
+                        await self.send_part(channel_id, ctx, part, file if index == len(message_parts) - 1 else None)
+                    self.send_latencies.append(time.monotonic() - queued_at)
+                except Exception as e:
+                    print(f"Error in OutboundQueue: {e}")
+                    traceback.print_exc()
+                    delivered = False
+                for done in futures:
+                    if not done.done():
+                        done.set_result(delivered)
+        finally:
+            del self.workers[channel_id]
+
+    async def take_token(self, channel_id):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(channel_id, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate / self.per)
+        if tokens < 1:
+            await asyncio.sleep((1 - tokens) * self.per / self.rate)
+            now = time.monotonic()
+            tokens = 1
+        self.buckets[channel_id] = (tokens - 1, now)
+
+    async def send_part(self, channel_id, ctx, part, file=None):
+        for _ in range(self.max_retries):
+            await self.take_token(channel_id)
+            try:
+                if file is None:
+                    await ctx.send(part)
+                else:
+                    file.reset()
+                    await ctx.send(part, file=file)
+                self.messages_sent += 1
+                return
+            except discord.RateLimited as e:
+                # discord.py logged this 429 before raising, so RateLimitLogHandler has already counted it.
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                # discord.HTTPException and the fake transports used in testing both carry the HTTP status.
+                if getattr(e, "status", None) != 429:
+                    raise
+                self.rate_limited += 1
+                await asyncio.sleep(getattr(e, "retry_after", None) or self.per / self.rate)
+        raise RuntimeError(f"Still rate limited after {self.max_retries} attempts.")
+
+    async def flush(self, timeout=None):
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+
+    def stats(self):
+        latencies = list(self.send_latencies)
+        return {
+            "messages_sent": self.messages_sent,
+            "rate_limited": self.rate_limited,
+            "queued": sum(len(pending) for pending in self.pending.values()),
+            "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+            "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        }
+
+class RateLimitLogHandler(logging.Handler):
+
+    #discord.py retries most 429s itself and only says so in a warning on the discord.http logger, so they never reach
+    #OutboundQueue as exceptions. This counts them from the log instead.
+    def __init__(self, queue):
+        super().__init__(logging.WARNING)
+        self.queue = queue
+
+    def emit(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith("We are being rate limited."):
+            self.queue.rate_limited += 1
+
+outbound_queue = OutboundQueue()
+logging.getLogger("discord.http").addHandler(RateLimitLogHandler(outbound_queue))
+
+async def send_message(ctx, message, ack=False, file=None):
+
+    #Queues a message for the channel and returns straight away. Await the returned future to wait for delivery.
+    return outbound_queue.enqueue(ctx, message, ack, file)
 
 async def generate_response(prompt, channel_id, is_progress_summary=False):
     
@@ -237,45 +516,85 @@ async def generate_response(prompt, channel_id, is_progress_summary=False):
             for _, (char, username) in characters[channel_id].items()
         )
 
-        def call_openai_api():
-            
-            #Call the OpenAI API to get a response! Lots of conditional business here as the messages are different depending on whether it's calling for a response to the user or to produce a progress summary.
-            current_max_progress_summary = max_progress_summary if is_progress_summary else max_user_progress_summary
-            truncated_progress_summary = truncate_progress_summary(progress_summary[channel_id], current_max_progress_summary)
-
-            current_max_chat_history = max_chat_history if is_progress_summary else max_user_chat_history
-            truncated_chat_history = truncate_chat_history(chat_history[channel_id], current_max_chat_history)
-
-            current_temperature = 0.5 if is_progress_summary else temperature[channel_id]
+        def build_stable_messages(truncated_progress_summary, truncated_chat_history):
 
-            truncated_chat_history_str = '\n'.join(f"{entry['content']}" for entry in truncated_chat_history)
-            truncated_progress_summary_str = '\n'.join(truncated_progress_summary)
+            #Orders the prompt from the parts that change least to the parts that change most, so consecutive requests share a long identical prefix for provider-side prompt caching.
             if is_progress_summary:
-                system_message = f"{summary_priming_prompt[channel_id]}\n\nParty details:\n{all_character_info}\n\nCampaign progress:\n\n{truncated_progress_summary}"
+                stable_messages = [{"role": "system", "content": summary_priming_prompt[channel_id]}]
             else:
-                system_message = f"{priming_prompt_base[channel_id]}\n\nParty details:\n{all_character_info}\n\nCampaign overview: Here is an outline of the campaign the players are undertaking. These events may not have occured yet and it is important you do not spoil the campaign by accidentally revealing the events to the players early. Reference the 'Campaign progress:' and 'Chat history:' sections to determine the events that have already occurred and the current state of play.\n\n{campaign_overview[channel_id]}\n\nCampaign progress: Here is the most recent progress the party has made in the campaign.\n\n{truncated_progress_summary}"
-            messages = [
-                {"role": "system", "content": system_message},
+                stable_messages = [{"role": "system", "content": f"{priming_prompt_base[channel_id]}\n\nCampaign overview: Here is an outline of the campaign the players are undertaking. These events may not have occured yet and it is important you do not spoil the campaign by accidentally revealing the events to the players early. Reference the 'Campaign progress:' and 'Chat history:' sections to determine the events that have already occurred and the current state of play.\n\n{campaign_overview[channel_id]}"}]
+            progress_text = "\n".join(truncated_progress_summary) or "No progress yet."
+            return [
+                *stable_messages,
+                {"role": "system", "content": f"Party details:\n{all_character_info}"},
+                {"role": "system", "content": f"Campaign progress: Here is the most recent progress the party has made in the campaign.\n\n{progress_text}"},
                 {"role": "assistant", "content": "Chat history: Here is the most recent chat history to help you determine the state of play.\n\n"},
                 *truncated_chat_history,
                 {"role": "user", "content": prompt}
             ]
+
+        def call_openai_api():
+            
+            #Call the OpenAI API to get a response! Lots of conditional business here as the messages are different depending on whether it's calling for a response to the user or to produce a progress summary.
+            stable_layout = prompt_layout.get(channel_id, "stable") == "stable"
+            with timed_stage("truncate"):
+                current_max_progress_summary = max_progress_summary if is_progress_summary else max_user_progress_summary
+                truncated_progress_summary = truncate_progress_summary(progress_summary[channel_id], current_max_progress_summary)
+
+                current_max_chat_history = max_chat_history if is_progress_summary else max_user_chat_history
+                if stable_layout:
+                    truncated_chat_history = truncate_chat_history_chunked(chat_history[channel_id], current_max_chat_history)
+                else:
+                    truncated_chat_history = truncate_chat_history(chat_history[channel_id], current_max_chat_history)
+
+            current_temperature = 0.5 if is_progress_summary else temperature[channel_id]
+
+            with timed_stage("prompt_assembly"):
+                truncated_chat_history_str = '\n'.join(f"{entry['content']}" for entry in truncated_chat_history)
+                truncated_progress_summary_str = '\n'.join(truncated_progress_summary)
+                if stable_layout:
+                    messages = build_stable_messages(truncated_progress_summary, truncated_chat_history)
+                elif is_progress_summary:
+                    system_message = f"{summary_priming_prompt[channel_id]}\n\nParty details:\n{all_character_info}\n\nCampaign progress:\n\n{truncated_progress_summary}"
+                else:
+                    system_message = f"{priming_prompt_base[channel_id]}\n\nParty details:\n{all_character_info}\n\nCampaign overview: Here is an outline of the campaign the players are undertaking. These events may not have occured yet and it is important you do not spoil the campaign by accidentally revealing the events to the players early. Reference the 'Campaign progress:' and 'Chat history:' sections to determine the events that have already occurred and the current state of play.\n\n{campaign_overview[channel_id]}\n\nCampaign progress: Here is the most recent progress the party has made in the campaign.\n\n{truncated_progress_summary}"
+                if not stable_layout:
+                    messages = [
+                        {"role": "system", "content": system_message},
+                        {"role": "assistant", "content": "Chat history: Here is the most recent chat history to help you determine the state of play.\n\n"},
+                        *truncated_chat_history,
+                        {"role": "user", "content": prompt}
+                    ]
             
-            messages_string = ' '.join(f"{entry['role']}: {entry['content']}" for entry in messages)
-            input_tokens[channel_id] = num_tokens_from_string(messages_string, "cl100k_base")
+            with timed_stage("tokenize"):
+                messages_string = ' '.join(f"{entry['role']}: {entry['content']}" for entry in messages)
+                input_tokens[channel_id] = num_tokens_from_string(messages_string, "cl100k_base")
+
+            overlap = record_prefix_overlap(channel_id, is_progress_summary, messages_string)
 
             response_max_tokens = 4096 - input_tokens[channel_id] - 200  # -200 for safety.
 
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                max_tokens=response_max_tokens,
-                n=1,
-                stop=None,
-                temperature=current_temperature,
-            )
-            print(f"Message sent to OpenAI: {messages}")
-            print(f"Total input tokens: {input_tokens[channel_id]}")
+            openai_budget.acquire()
+            try:
+                with timed_stage("api_call"):
+                    response = completion_backend(
+                        model="gpt-3.5-turbo",
+                        messages=messages,
+                        max_tokens=response_max_tokens,
+                        n=1,
+                        stop=None,
+                        temperature=current_temperature,
+                    )
+            finally:
+                openai_budget.release()
+            counts = token_counts.setdefault(channel_id, [0, 0])
+            counts[0] += input_tokens[channel_id]
+            counts[1] += response.get('usage', {}).get('completion_tokens', 0)
+            spans = current_turn_spans.get()
+            if spans is not None:
+                spans["input_tokens"] = spans.get("input_tokens", 0) + input_tokens[channel_id]
+                if overlap is not None:
+                    spans["summary_prefix_overlap" if is_progress_summary else "prefix_overlap"] = round(overlap, 3)
             response = response['choices'][0]['message']['content'].strip()
             while response.startswith(f"{chatbot_name[channel_id]}: "):
                 response = response[len(chatbot_name[channel_id]) + 2:]  # Remove the chatbot_name and the ": " (2 characters)
@@ -285,26 +604,264 @@ async def generate_response(prompt, channel_id, is_progress_summary=False):
         print(f"Error in generate_response: {e}")
         traceback.print_exc()
         return "I'm sorry, I encountered an error. Please try again."
-    response_text = await asyncio.to_thread(call_openai_api)
+    response_text = await asyncio.to_thread(maybe_profiled, call_openai_api)
     return response_text
 
+def record_prefix_overlap(channel_id, is_progress_summary, prompt_text):
+
+    #Share of this prompt that is identical to the start of the previous prompt of the same kind in the channel. Roughly how much of it the provider could serve from its prompt cache.
+    key = (channel_id, is_progress_summary)
+    previous = last_prompt_text.get(key)
+    last_prompt_text[key] = prompt_text
+    if previous is None or not prompt_text:
+        return None
+    overlap = len(os.path.commonprefix([previous, prompt_text])) / len(prompt_text)
+    prefix_overlaps.append(overlap)
+    return overlap
+
+class OpenAIBudget:
+
+    #Limits concurrent OpenAI calls and calls per minute. Built from multiprocessing primitives so the supervisor can hand one budget to every worker process.
+    #acquire() blocks, so only call it from the worker thread that makes the API call.
+    #Each concurrency slot records the pid holding it, so when a worker is killed mid-call the supervisor can hand its slots back with reclaim().
+    def __init__(self, max_concurrent=8, calls_per_minute=3500, poll_interval=0.05, lock_timeout=1):
+        self.calls_per_minute = calls_per_minute
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.lock = multiprocessing.Lock()
+        self.lock_owner = multiprocessing.Value("i", 0, lock=False)
+        self.slot_owners = multiprocessing.Array("i", max_concurrent, lock=False)
+        self.tokens = multiprocessing.Value("d", calls_per_minute, lock=False)
+        self.updated = multiprocessing.Value("d", time.time(), lock=False)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            self.lock_owner.value = os.getpid()
+            try:
+                yield
+            finally:
+                self.lock_owner.value = 0
+
+    def acquire(self):
+        pid = os.getpid()
+        slot = None
+        while True:
+            with self.locked():
+                if slot is None and 0 in self.slot_owners:
+                    slot = self.slot_owners[:].index(0)
+                    self.slot_owners[slot] = pid
+                if slot is None:
+                    wait = self.poll_interval
+                else:
+                    now = time.time()
+                    tokens = min(self.calls_per_minute, self.tokens.value + (now - self.updated.value) * self.calls_per_minute / 60)
+                    self.updated.value = now
+                    if tokens >= 1:
+                        self.tokens.value = tokens - 1
+                        return
+                    self.tokens.value = tokens
+                    wait = (1 - tokens) * 60 / self.calls_per_minute
+            time.sleep(wait)
+
+    def release(self):
+        with self.locked():
+            self.slot_owners[self.slot_owners[:].index(os.getpid())] = 0
+
+    def reclaim(self, pid):
+        #Hands back every slot held by a worker that has died, and the lock if it died holding it. Returns the number of slots freed.
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            if self.lock_owner.value not in (0, pid):
+                print(f"Could not reclaim OpenAI budget slots from pid {pid}: the budget lock is held by pid {self.lock_owner.value}.")
+                return 0
+            # Nothing holds the lock for more than a moment, so the dead worker was killed holding it. Taking it over is safe.
+            print(f"Took over the OpenAI budget lock from dead pid {pid}.")
+        try:
+            freed = 0
+            for slot, owner in enumerate(self.slot_owners):
+                if owner == pid:
+                    self.slot_owners[slot] = 0
+                    freed += 1
+            return freed
+        finally:
+            self.lock_owner.value = 0
+            self.lock.release()
+
+openai_budget = OpenAIBudget()
+
+#Metrics for !stats and the local metrics endpoint.
+
+metrics_server = None
+
+def render_metrics():
+
+    #Prometheus text format. The dmbot_recent_* series only cover the last STAGE_LATENCY_WINDOW timings of each stage.
+    with stage_totals_lock:
+        totals = {stage: list(values) for stage, values in stage_totals.items()}
+        latencies = {stage: list(values) for stage, values in stage_latencies.items()}
+    lines = ["# TYPE dmbot_stage_calls_total counter"]
+    lines += [f'dmbot_stage_calls_total{{stage="{stage}"}} {count}' for stage, (count, _, _) in sorted(totals.items())]
+    lines.append("# TYPE dmbot_stage_wall_seconds_total counter")
+    lines += [f'dmbot_stage_wall_seconds_total{{stage="{stage}"}} {wall:.6f}' for stage, (_, wall, _) in sorted(totals.items())]
+    lines.append("# TYPE dmbot_stage_cpu_seconds_total counter")
+    lines += [f'dmbot_stage_cpu_seconds_total{{stage="{stage}"}} {cpu:.6f}' for stage, (_, _, cpu) in sorted(totals.items()) if cpu is not None]
+    lines.append("# TYPE dmbot_recent_stage_seconds gauge")
+    for stage, values in sorted(latencies.items()):
+        for quantile in (0.5, 0.95, 0.99):
+            lines.append(f'dmbot_recent_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {percentile(values, quantile):.6f}')
+    lines.append("# TYPE dmbot_recent_stage_seconds_bucket gauge")
+    for stage, values in sorted(latencies.items()):
+        for bound in STAGE_LATENCY_BUCKETS:
+            lines.append(f'dmbot_recent_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {sum(1 for value in values if value <= bound)}')
+        lines.append(f'dmbot_recent_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {len(values)}')
+    lines.append("# TYPE dmbot_input_tokens_total counter")
+    lines += [f'dmbot_input_tokens_total{{channel="{channel_id}"}} {counts[0]}' for channel_id, counts in list(token_counts.items())]
+    lines.append("# TYPE dmbot_output_tokens_total counter")
+    lines += [f'dmbot_output_tokens_total{{channel="{channel_id}"}} {counts[1]}' for channel_id, counts in list(token_counts.items())]
+    lines.append("# TYPE dmbot_last_input_tokens gauge")
+    lines += [f'dmbot_last_input_tokens{{channel="{channel_id}"}} {tokens}' for channel_id, tokens in list(input_tokens.items())]
+    queue_stats = outbound_queue.stats()
+    lines.append("# TYPE dmbot_messages_sent_total counter")
+    lines.append(f"dmbot_messages_sent_total {queue_stats['messages_sent']}")
+    lines.append("# TYPE dmbot_rate_limited_total counter")
+    lines.append(f"dmbot_rate_limited_total {queue_stats['rate_limited']}")
+    lines.append("# TYPE dmbot_outbound_queued gauge")
+    lines.append(f"dmbot_outbound_queued {queue_stats['queued']}")
+    overlaps = list(prefix_overlaps)
+    lines.append("# TYPE dmbot_recent_prefix_overlap gauge")
+    for quantile in (0.5, 0.95):
+        lines.append(f'dmbot_recent_prefix_overlap{{quantile="{quantile}"}} {percentile(overlaps, quantile):.4f}')
+    lines.append("# TYPE dmbot_profile_samples gauge")
+    lines.append(f"dmbot_profile_samples {profile_samples}")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render_metrics().encode()
+        writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        print(f"Error in handle_metrics_request: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(port):
+
+    #Only listens on localhost. Set PORT under [METRICS] in config.ini to turn it on.
+    global metrics_server
+    if metrics_server is None and port:
+        metrics_server = await asyncio.start_server(handle_metrics_request, "127.0.0.1", port)
+        print(f"Metrics available at http://127.0.0.1:{port}/metrics")
+
+#Offline rules lookups. The SRD index is only built the first time someone asks a rules question.
+
+SRD_FILE = pathlib.Path(__file__).parent / "srd" / "srd_5e.json"
+SRD_CATEGORIES = {"conditions": "Condition", "spells": "Spell", "monsters": "Monster", "equipment": "Equipment"}
+rules_index = None
+rules_injection = {}
+
+def normalise_rules_name(name):
+    # Apostrophes are dropped rather than split on, so "thieves tools" finds Thieves' Tools and "will o wisp" finds Will-o'-Wisp.
+    return " ".join(re.findall(r"[a-z0-9]+", re.sub(r"['\u2019]", "", name.lower())))
+
+def rules_trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class RulesIndex:
+
+    #Fuzzy name index over the bundled SRD entries. An exact match, or the only entry starting with the query, wins. Anything else,
+    #including a prefix shared by several entries, is ranked by shared character trigrams and only offered as a suggestion.
+    def __init__(self, srd_data):
+        self.entries = []
+        self.by_name = {}
+        self.trigrams = {}
+        self.trigram_counts = []
+        self.max_name_words = 1
+        for category, label in SRD_CATEGORIES.items():
+            for name, text in srd_data.get(category, {}).items():
+                entry_id = len(self.entries)
+                key = normalise_rules_name(name)
+                self.entries.append((name, label, text))
+                self.by_name.setdefault(key, entry_id)
+                entry_trigrams = rules_trigrams(key)
+                self.trigram_counts.append(len(entry_trigrams))
+                for trigram in entry_trigrams:
+                    self.trigrams.setdefault(trigram, set()).add(entry_id)
+                self.max_name_words = max(self.max_name_words, len(key.split()))
+
+    def lookup(self, query, limit=3):
+        #Returns (matches, exact). exact is only True when the first match is an exact hit or the only prefix hit, so callers can
+        #tell a real answer from a list of suggestions. Prefix hits are listed shortest name first.
+        key = normalise_rules_name(query)
+        if not key:
+            return [], False
+        ranked = []
+        if key in self.by_name:
+            ranked.append(self.by_name[key])
+        prefix_keys = sorted((entry_key for entry_key in self.by_name if entry_key != key and entry_key.startswith(key)), key=len)
+        exact = bool(ranked) or len(prefix_keys) == 1
+        ranked.extend(self.by_name[entry_key] for entry_key in prefix_keys)
+        if len(ranked) < limit:
+            query_trigrams = rules_trigrams(key)
+            shared = {}
+            for trigram in query_trigrams:
+                for entry_id in self.trigrams.get(trigram, ()):
+                    shared[entry_id] = shared.get(entry_id, 0) + 1
+            scored = sorted(
+                ((2 * count / (len(query_trigrams) + self.trigram_counts[entry_id]), entry_id) for entry_id, count in shared.items() if entry_id not in ranked),
+                reverse=True,
+            )
+            ranked.extend(entry_id for score, entry_id in scored if score >= 0.4)
+        return [self.entries[entry_id] for entry_id in ranked[:limit]], exact
+
+    def find_mentions(self, text, limit=2):
+        #Returns entries whose exact name appears in the text, longest names first.
+        words = normalise_rules_name(text).split()
+        found = []
+        for size in range(min(self.max_name_words, len(words)), 0, -1):
+            for start in range(len(words) - size + 1):
+                entry_id = self.by_name.get(" ".join(words[start:start + size]))
+                if entry_id is not None and entry_id not in found:
+                    found.append(entry_id)
+                    if len(found) >= limit:
+                        return [self.entries[entry_id] for entry_id in found]
+        return [self.entries[entry_id] for entry_id in found]
+
+def get_rules_index():
+    global rules_index
+    if rules_index is None:
+        with open(SRD_FILE, "r") as f:
+            rules_index = RulesIndex(json.load(f))
+    return rules_index
+
 #Stuff to save and load games.
 
 async def periodic_save():
     while True:
         await asyncio.sleep(60 * 5)  # Save every 5 minutes
-        for channel_id in campaign_overview.keys():
-            save_data(channel_id)
+        flush_dirty_channels()
+
+def flush_dirty_channels():
+
+    #Saves every loaded channel that has changed since it was last saved.
+    for channel_id in list(dirty_channels):
+        if channel_id in campaign_overview:
+            try:
+                save_data(channel_id)
+            except Exception as e:
+                print(f"Error saving channel {channel_id}: {e}")
+                traceback.print_exc()
+        else:
+            dirty_channels.discard(channel_id)
         
 def get_data_file(channel_id):
-    current_path = pathlib.Path(__file__).parent
-    save_data_directory = current_path / "save_data"
-    save_data_directory.mkdir(parents=True, exist_ok=True)
-    return save_data_directory / f"data_{channel_id}.json"
+    SAVE_DATA_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    return SAVE_DATA_DIRECTORY / f"data_{channel_id}.json"
 
-def save_data(channel_id):
-    data_file = get_data_file(channel_id)
-    data = {
+def channel_data(channel_id):
+    return {
         "campaign_overview": campaign_overview[channel_id],
         "progress_summary": progress_summary[channel_id],
         "characters": {
@@ -318,8 +875,13 @@ def save_data(channel_id):
         "priming_prompt_base": priming_prompt_base[channel_id],
         "summary_priming_prompt": summary_priming_prompt[channel_id],
     }
+
+def save_data(channel_id):
+    data_file = get_data_file(channel_id)
+    data = channel_data(channel_id)
     with open(data_file, "w") as f:
         json.dump(data, f)
+    dirty_channels.discard(channel_id)
 
 def load_data(channel_id):
     global campaign_overview, progress_summary, characters, chat_history, priming_prompt_base, summary_priming_prompt
@@ -337,26 +899,27 @@ def load_data(channel_id):
     else:
         with open(data_file, "r") as f:
             data = json.load(f)
-
-        campaign_overview[channel_id] = data["campaign_overview"]
-        progress_summary[channel_id] = data["progress_summary"]
-        characters[channel_id] = {
-            int(user_id): (
-                Character(
-                    data["characters"][user_id]["character"]["name"],
-                    data["characters"][user_id]["character"]["race"],
-                    data["characters"][user_id]["character"]["character_class"],
-                    data["characters"][user_id]["character"]["background"],
-                    data["characters"][user_id]["character"]["alignment"],
-                ),
-                data["characters"][user_id]["username"],
-            )
-            for user_id in data["characters"]
-        }
-        for user_id in characters[channel_id]:
-            characters[channel_id][user_id][0].__dict__.update(data["characters"][str(user_id)]["character"])
-        chat_history[channel_id] = data.get("chat_history", [])
-    
+        apply_channel_data(channel_id, data)
+
+def apply_channel_data(channel_id, data):
+    campaign_overview[channel_id] = data["campaign_overview"]
+    progress_summary[channel_id] = data["progress_summary"]
+    characters[channel_id] = {
+        int(user_id): (
+            Character(
+                data["characters"][user_id]["character"]["name"],
+                data["characters"][user_id]["character"]["race"],
+                data["characters"][user_id]["character"]["character_class"],
+                data["characters"][user_id]["character"]["background"],
+                data["characters"][user_id]["character"]["alignment"],
+            ),
+            data["characters"][user_id]["username"],
+        )
+        for user_id in data["characters"]
+    }
+    for user_id in characters[channel_id]:
+        characters[channel_id][user_id][0].__dict__.update(data["characters"][str(user_id)]["character"])
+    chat_history[channel_id] = data.get("chat_history", [])
     priming_prompt_base[channel_id] = data.get("priming_prompt_base", default_priming_prompt_base)
     summary_priming_prompt[channel_id] = data.get("summary_priming_prompt", default_summary_priming_prompt)
     if summary_priming_prompt[channel_id] == "":
@@ -364,6 +927,137 @@ def load_data(channel_id):
     if priming_prompt_base[channel_id] == "":
         priming_prompt_base[channel_id] = default_priming_prompt_base
         
+def get_warm_snapshot_file():
+    SAVE_DATA_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    return SAVE_DATA_DIRECTORY / warm_snapshot_name
+
+def write_warm_snapshot():
+
+    #Writes every recently active channel to a single file, so the next start can load them all in one pass instead of one file per channel on first use.
+    cutoff = time.time() - WARM_SNAPSHOT_MAX_AGE
+    snapshot = {
+        "written_at": time.time(),
+        "channels": {
+            str(channel_id): {"last_active": active, "data": channel_data(channel_id)}
+            for channel_id, active in last_active.items()
+            if active >= cutoff and channel_id in campaign_overview
+        },
+    }
+    snapshot_file = get_warm_snapshot_file()
+    temporary_file = snapshot_file.with_suffix(".tmp")
+    with open(temporary_file, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(temporary_file, snapshot_file)
+    print(f"Warm snapshot written with {len(snapshot['channels'])} channels.")
+
+def load_warm_snapshot():
+
+    #The snapshot is deleted once loaded. The per-channel save files are newer from then on, so it must never be loaded a second time.
+    #A snapshot can also be left behind by an earlier layout (warm_snapshot_{n}.json after running fewer processes, or
+    #warm_snapshot.json after switching to sharding), so anything older than WARM_SNAPSHOT_MAX_AGE is ignored, and so is any
+    #channel whose save file was written after the snapshot.
+    snapshot_file = get_warm_snapshot_file()
+    if not snapshot_file.exists():
+        return
+    try:
+        with open(snapshot_file, "r") as f:
+            snapshot = json.load(f)
+        written_at = snapshot.get("written_at", 0)
+        if time.time() - written_at > WARM_SNAPSHOT_MAX_AGE:
+            print(f"Ignoring warm snapshot {snapshot_file.name}: it is older than {WARM_SNAPSHOT_MAX_AGE} seconds.")
+            return
+        loaded = 0
+        for channel_key, entry in snapshot.get("channels", {}).items():
+            channel_id = int(channel_key)
+            data_file = get_data_file(channel_id)
+            if data_file.exists() and data_file.stat().st_mtime > written_at:
+                continue
+            # last_active is deliberately left alone: only channels used by this process go into its next snapshot.
+            apply_channel_data(channel_id, entry["data"])
+            loaded += 1
+        print(f"Warm snapshot loaded with {loaded} of {len(snapshot.get('channels', {}))} channels.")
+    except Exception as e:
+        print(f"Error in load_warm_snapshot: {e}")
+        traceback.print_exc()
+    finally:
+        snapshot_file.unlink(missing_ok=True)
+
+async def graceful_shutdown():
+
+    #Stops taking new turns and saves everything that changed straight away, so a hung turn or a slow queue can't lose it. Then lets the
+    #turns in progress finish and their replies go out, saves again and writes the warm snapshot. Draining shares a single
+    #SHUTDOWN_TIMEOUT deadline, which stays inside the time the supervisor allows before it kills the worker.
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_TIMEOUT
+    try:
+        flush_dirty_channels()
+        print(f"Shutting down: waiting for {len(in_flight_turns)} turns in progress...")
+        if in_flight_turns:
+            await asyncio.wait(list(in_flight_turns), timeout=max(0, deadline - loop.time()))
+        await outbound_queue.flush(max(0, deadline - loop.time()))
+        flush_dirty_channels()
+        write_warm_snapshot()
+    except Exception as e:
+        print(f"Error in graceful_shutdown: {e}")
+        traceback.print_exc()
+    finally:
+        await bot.close()
+
+def ensure_channel_loaded(channel_id):
+    # Load data for the channel if it hasn't been loaded yet
+    if channel_id not in campaign_overview:
+        load_data(channel_id)
+
+#Paged campaign logs and transcript export.
+
+LOG_PAGE_CHARACTERS = 1800
+LOG_PAGE_ENTRIES = 25
+log_page_index = {}
+
+def log_page_offsets(channel_id, log_name, entries, render):
+
+    #Returns the offset of the first entry on each page of a log. Logs only ever grow, so the index carries on from the last entry it saw instead of rescanning. It is rebuilt if the log was cleared or replaced.
+    #The index holds on to the list itself rather than its id(), which CPython can hand to a new list once the old one is freed.
+    key = (channel_id, log_name)
+    index = log_page_index.get(key)
+    if index is None or index["entries"] is not entries or index["indexed"] > len(entries):
+        index = {"entries": entries, "offsets": [0], "indexed": 0, "page_characters": 0}
+        log_page_index[key] = index
+
+    offsets = index["offsets"]
+    page_characters = index["page_characters"]
+    for position in range(index["indexed"], len(entries)):
+        entry_characters = len(render(entries[position])) + 1
+        if position > offsets[-1] and (page_characters + entry_characters > LOG_PAGE_CHARACTERS or position - offsets[-1] >= LOG_PAGE_ENTRIES):
+            offsets.append(position)
+            page_characters = 0
+        page_characters += entry_characters
+    index["indexed"] = len(entries)
+    index["page_characters"] = page_characters
+    return offsets
+
+def write_campaign_export(channel_id, export_file):
+
+    #Writes a gzipped plain text transcript one entry at a time. Runs in a worker thread. It only reads up to the log lengths it saw at the start, so new entries added meanwhile are left for the next export.
+    with gzip.GzipFile(filename=f"campaign_{channel_id}.txt", mode="wb", fileobj=export_file) as archive:
+        archive.write(f"Campaign overview:\n{campaign_overview.get(channel_id, '')}\n\nParty:\n".encode())
+        for _, (char, username) in list(characters.get(channel_id, {}).items()):
+            archive.write(f"{username}: {char.display_character()}\n".encode())
+
+        archive.write(b"\nProgress summary:\n")
+        events = progress_summary.get(channel_id) or []
+        for position in range(len(events)):
+            archive.write(f"{events[position]}\n".encode())
+
+        archive.write(b"\nChat history:\n")
+        entries = chat_history.get(channel_id) or []
+        for position in range(len(entries)):
+            archive.write(f"{entries[position]['content']}\n".encode())
+
 def clear_save(channel_id):
     global campaign_overview, progress_summary, characters, chat_history
 
@@ -387,16 +1081,17 @@ async def update_ac(ctx, armor_class: int):
         channel_id = ctx.channel.id
 
         if channel_id not in characters or user_id not in characters[channel_id]:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
             return
         
         character, _ = characters[channel_id][user_id]
+        before = character.sheet_fields()
         
         character.armor_class = armor_class
-        await ctx.send(f"Armor Class updated for {ctx.author.name}:\n{character.display_character()}")
+        await send_message(ctx, f"Armor Class updated for {ctx.author.name}:\n{character.sheet_diff(before)}", ack=True)
     except Exception as e:
         print(f"Error in update_ac: {e}")
-        await ctx.send("An error occurred while updating your armor class. Please try again.")
+        await send_message(ctx, "An error occurred while updating your armor class. Please try again.")
 
 @bot.command()
 async def update_hp(ctx, hit_points: int):
@@ -405,15 +1100,16 @@ async def update_hp(ctx, hit_points: int):
         channel_id = ctx.channel.id
 
         if channel_id not in characters or user_id not in characters[channel_id]:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
             return
 
         character, _ = characters[channel_id][user_id]
+        before = character.sheet_fields()
         character.hit_points = hit_points
-        await ctx.send(f"Hit Points updated for {ctx.author.name}:\n{character.display_character()}")
+        await send_message(ctx, f"Hit Points updated for {ctx.author.name}:\n{character.sheet_diff(before)}", ack=True)
     except Exception as e:
         print(f"Error in update_hp: {e}")
-        await ctx.send("An error occurred while updating your hit points. Please try again.")
+        await send_message(ctx, "An error occurred while updating your hit points. Please try again.")
     
 @bot.command()
 async def create_character(ctx, *, args):
@@ -424,7 +1120,7 @@ async def create_character(ctx, *, args):
         split_args = [arg.strip() for arg in args.split(',')]  # Split input by commas
 
         if len(split_args) < 5:
-            await ctx.send("Not enough arguments provided. Please follow the format: [name], [race], [class], [background], [alignment], [notes]")
+            await send_message(ctx, "Not enough arguments provided. Please follow the format: [name], [race], [class], [background], [alignment], [notes]")
             return
 
         name, race, character_class, background, alignment = split_args[:5]  # Unpack the first five elements of split_args
@@ -436,10 +1132,10 @@ async def create_character(ctx, *, args):
             characters[channel_id] = {}
 
         characters[channel_id][user_id] = (Character(name, race, character_class, background, alignment, notes), username)
-        await ctx.send(f"Character created for {ctx.author.name}:\n{characters[channel_id][user_id][0].display_character()}")
+        await send_message(ctx, f"Character created for {ctx.author.name}:\n{characters[channel_id][user_id][0].display_character()}")
     except Exception as e:
         print(f"Error in create_character: {e}")
-        await ctx.send("An error occurred while creating your character. Please try again.")
+        await send_message(ctx, "An error occurred while creating your character. Please try again.")
 
 @bot.command()
 async def update_character(ctx, attribute: str, *, value: str):
@@ -448,7 +1144,7 @@ async def update_character(ctx, attribute: str, *, value: str):
         channel_id = ctx.channel.id
 
         if channel_id not in characters or user_id not in characters[channel_id]:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
             return
 
         character, _ = characters[channel_id][user_id]
@@ -463,13 +1159,14 @@ async def update_character(ctx, attribute: str, *, value: str):
         attribute_key = attribute_mapping.get(attribute.lower())
 
         if attribute_key:
+            before = character.sheet_fields()
             setattr(character, attribute_key, value)
-            await ctx.send(f"{attribute.capitalize()} updated for {ctx.author.name}:\n{character.display_character()}")
+            await send_message(ctx, f"{attribute.capitalize()} updated for {ctx.author.name}:\n{character.sheet_diff(before)}", ack=True)
         else:
-            await ctx.send("Invalid attribute. Please use name, race, class, or background.")
+            await send_message(ctx, "Invalid attribute. Please use name, race, class, or background.")
     except Exception as e:
         print(f"Error in update_character: {e}")
-        await ctx.send("An error occurred while updating your character. Please try again.")
+        await send_message(ctx, "An error occurred while updating your character. Please try again.")
 
 @bot.command()
 async def update_stats(ctx, *, stats_str: str = None):
@@ -481,10 +1178,11 @@ async def update_stats(ctx, *, stats_str: str = None):
             characters[channel_id] = {}
 
         if user_id not in characters[channel_id]:
-            await ctx.send("You don't have a character yet. Create one using the `!create_character` command.")
+            await send_message(ctx, "You don't have a character yet. Create one using the `!create_character` command.")
             return
 
         character, _ = characters[channel_id][user_id]
+        before = character.sheet_fields()
 
         if stats_str is not None:
             # Split the stats string and create a dictionary of stat names and values
@@ -494,10 +1192,10 @@ async def update_stats(ctx, *, stats_str: str = None):
             for stat, value in stats_dict.items():
                 character.stats[stat.lower()] = value
 
-        await ctx.send(f"{ctx.author.name}, your character's stats have been updated:\n{character.display_character()}")
+        await send_message(ctx, f"{ctx.author.name}, your character's stats have been updated:\n{character.sheet_diff(before)}", ack=True)
     except Exception as e:
         print(f"Error in update_stats: {e}")
-        await ctx.send("An error occurred while updating your stats. Please try again.")
+        await send_message(ctx, "An error occurred while updating your stats. Please try again.")
 
 @bot.command()
 async def update_level(ctx, level: int):
@@ -508,12 +1206,12 @@ async def update_level(ctx, level: int):
 
         if character:
             character.level = level
-            await ctx.send(f"Level updated for {ctx.author.name}:\nLevel {character.level}")
+            await send_message(ctx, f"Level updated for {ctx.author.name}:\nLevel {character.level}", ack=True)
         else:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
     except Exception as e:
         print(f"Error in update_level: {e}")
-        await ctx.send("An error occurred while updating your level. Please try again.")
+        await send_message(ctx, "An error occurred while updating your level. Please try again.")
 
 @bot.command()
 async def update_xp(ctx, xp: int):
@@ -524,13 +1222,13 @@ async def update_xp(ctx, xp: int):
 
         if character:
             character.xp = xp
-            await ctx.send(f"XP updated for {ctx.author.name}:\n{character.xp} XP")
+            await send_message(ctx, f"XP updated for {ctx.author.name}:\n{character.xp} XP", ack=True)
         else:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
     except Exception as e:
         print(f"Error in update_xp: {e}")
         traceback.print_exc()
-        await ctx.send("An error occurred while updating your XP. Please try again.")
+        await send_message(ctx, "An error occurred while updating your XP. Please try again.")
 
 
 @bot.command()
@@ -547,13 +1245,13 @@ async def update_inventory(ctx, *, args):
         if character:
             items = [item.strip() for item in args.split(',')]
             character.inventory = items
-            await ctx.send(f"Inventory updated for {ctx.author.name}:\n{', '.join(character.inventory)}")
+            await send_message(ctx, f"Inventory updated for {ctx.author.name}:\n{', '.join(character.inventory)}", ack=True)
         else:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
     except Exception as e:
         print(f"Error in update_inventory: {e}")
         traceback.print_exc()
-        await ctx.send("An error occurred while updating your inventory. Please try again.")
+        await send_message(ctx, "An error occurred while updating your inventory. Please try again.")
 
 @bot.command()
 async def update_spells(ctx, *, args):
@@ -568,13 +1266,13 @@ async def update_spells(ctx, *, args):
 
         if character:
             character.spells = [arg.strip() for arg in args.split(',')]
-            await ctx.send(f"Spells updated for {ctx.author.name}:\n{', '.join(character.spells)}")
+            await send_message(ctx, f"Spells updated for {ctx.author.name}:\n{', '.join(character.spells)}", ack=True)
         else:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
     except Exception as e:
         print(f"Error in update_spells: {e}")
         traceback.print_exc()
-        await ctx.send("An error occurred while updating your spells. Please try again.")
+        await send_message(ctx, "An error occurred while updating your spells. Please try again.")
 
 @bot.command()
 async def update_notes(ctx, *, args):
@@ -590,14 +1288,14 @@ async def update_notes(ctx, *, args):
         if character:
             if len(args) <= 200:
                 character.notes = args.strip()
-                await ctx.send(f"Notes updated for {ctx.author.name}:\n{character.notes}")
+                await send_message(ctx, f"Notes updated for {ctx.author.name}:\n{character.notes}", ack=True)
             else:
-                await ctx.send("Error: Notes must be no longer than 200 characters.")
+                await send_message(ctx, "Error: Notes must be no longer than 200 characters.")
         else:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
     except Exception as e:
         traceback.print_exc()
-        await ctx.send(f"Error: {str(e)}")
+        await send_message(ctx, f"Error: {str(e)}")
 
 @bot.command()
 async def display_character(ctx):
@@ -611,12 +1309,12 @@ async def display_character(ctx):
         character, _ = characters[channel_id].get(user_id)
 
         if character:
-            await send_split_message(ctx, f"Character details for {ctx.author.name}:\n{character.display_character()}")
+            await send_message(ctx, f"Character details for {ctx.author.name}:\n{character.display_character()}")
         else:
-            await ctx.send("No character found. Please create a character first.")
+            await send_message(ctx, "No character found. Please create a character first.")
     except Exception as e:
         traceback.print_exc()
-        await ctx.send(f"Error: {str(e)}")
+        await send_message(ctx, f"Error: {str(e)}")
 
 @bot.command()
 async def update_campaign_overview(ctx, *, overview: str):
@@ -627,14 +1325,14 @@ async def update_campaign_overview(ctx, *, overview: str):
         # Check if the overview is under the max_campaign_overview limit
         overview_length = num_tokens_from_string(overview, "cl100k_base")
         if overview_length > max_campaign_overview:
-            await ctx.send("Please try again with a shorter campaign overview.")
+            await send_message(ctx, "Please try again with a shorter campaign overview.")
             return
 
         campaign_overview[channel_id] = overview
-        await ctx.send(f"Campaign overview updated:\n{campaign_overview[channel_id]}")
+        await send_message(ctx, f"Campaign overview updated:\n{campaign_overview[channel_id]}")
     except Exception as e:
         traceback.print_exc()
-        await ctx.send(f"Error: {str(e)}")
+        await send_message(ctx, f"Error: {str(e)}")
 
 @bot.command(name="update_alignment")
 async def update_alignment(ctx, *, alignment: str):
@@ -644,44 +1342,158 @@ async def update_alignment(ctx, *, alignment: str):
 
     if channel_id in characters and user_id in characters[channel_id]:
         characters[channel_id][user_id].alignment = alignment
-        await ctx.send(f"Character alignment updated to {alignment}.")
+        await send_message(ctx, f"Character alignment updated to {alignment}.", ack=True)
     else:
-        await ctx.send("You don't have a character yet. Use !create_character to create one.")
+        await send_message(ctx, "You don't have a character yet. Use !create_character to create one.")
+
+async def send_log_page(ctx, title, log_name, entries, render, page, command):
+
+    #Sends one page of a campaign log. Negative pages count back from the newest, so -1 is the last page.
+    offsets = log_page_offsets(ctx.channel.id, log_name, entries, render)
+    total_pages = len(offsets) if entries else 0
+    if page < 0:
+        page = total_pages + page + 1
+    if not 1 <= page <= total_pages:
+        await send_message(ctx, f"Please choose a page between 1 and {total_pages}.")
+        return
+
+    start = offsets[page - 1]
+    end = offsets[page] if page < total_pages else len(entries)
+    page_text = "\n".join(render(entries[position]) for position in range(start, end))
+    cursors = []
+    if page > 1:
+        cursors.append(f"!{command} {page - 1} for older")
+    if page < total_pages:
+        cursors.append(f"!{command} {page + 1} for newer")
+    footer = f"Page {page} of {total_pages} (entries {start + 1}-{end} of {len(entries)})."
+    if cursors:
+        footer += " Use " + " or ".join(cursors) + "."
+    await send_message(ctx, f"{title}:\n\n{page_text}\n\n{footer}")
 
 @bot.command(name="display_progress_summary")
-async def display_progress_summary(ctx):
-    channel_id = ctx.channel.id
-    
-    # Load data for the channel if it hasn't been loaded yet
-    if channel_id not in campaign_overview:
-        load_data(channel_id)
-        if channel_id not in campaign_overview:
-            campaign_overview[channel_id] = ""
-            progress_summary[channel_id] = []
-            characters[channel_id] = {}
-            chat_history[channel_id] = []
-            priming_prompt_base[channel_id] = ""
+async def display_progress_summary(ctx, page: int = 1):
+    try:
+        channel_id = ctx.channel.id
+        ensure_channel_loaded(channel_id)
+
+        current_progress_summary = progress_summary.get(channel_id, [])
+        if current_progress_summary:
+            await send_log_page(ctx, "Progress Summary", "progress_summary", current_progress_summary, str, page, "display_progress_summary")
+        else:
+            await send_message(ctx, "No progress summary found for this channel.")
+    except Exception as e:
+        print(f"Error in display_progress_summary: {e}")
+        traceback.print_exc()
+        await send_message(ctx, "An error occurred while displaying the progress summary. Please try again.")
+
+@bot.command(name="history")
+async def history(ctx, page: int = -1):
+    try:
+        channel_id = ctx.channel.id
+        ensure_channel_loaded(channel_id)
+
+        current_chat_history = chat_history.get(channel_id) or []
+        if current_chat_history:
+            await send_log_page(ctx, "Chat History", "chat_history", current_chat_history, lambda entry: entry["content"], page, "history")
+        else:
+            await send_message(ctx, "No chat history found for this channel.")
+    except Exception as e:
+        print(f"Error in history: {e}")
+        traceback.print_exc()
+        await send_message(ctx, "An error occurred while displaying the chat history. Please try again.")
+
+@bot.command(name="export_campaign")
+async def export_campaign(ctx):
+    try:
+        channel_id = ctx.channel.id
+        ensure_channel_loaded(channel_id)
+
+        # The transcript is written to a temporary file rather than memory, so memory use stays flat however long the campaign is.
+        # It has to be a real file: discord.File only accepts io.IOBase objects, which SpooledTemporaryFile isn't before Python 3.11.
+        export_file = tempfile.TemporaryFile()
+        delivery = None
+        try:
+            await asyncio.to_thread(write_campaign_export, channel_id, export_file)
+            export_size = export_file.tell()
+            size_limit = getattr(ctx.guild, "filesize_limit", 10 * 1024 * 1024)
+            if export_size > size_limit:
+                await send_message(ctx, f"The campaign transcript is {export_size / 1024 / 1024:.1f} MB compressed, which is over this server's upload limit.")
+                return
+
+            export_file.seek(0)
+            # On Windows TemporaryFile returns a NamedTemporaryFile wrapper, which discord.File would take for a path, so it gets the file
+            # object inside. The wrapper is kept and closed below, since dropping it would close the file under the upload.
+            upload_file = getattr(export_file, "file", export_file)
+            delivery = await send_message(ctx, f"Campaign transcript ({export_size / 1024:.0f} KB compressed):", file=discord.File(upload_file, filename=f"campaign_{channel_id}.txt.gz"))
+        finally:
+            # discord.File never closes a file object it was handed, and the outbound queue may need it again to retry the upload,
+            # so it is closed once delivery has succeeded or given up.
+            if delivery is None:
+                export_file.close()
+            else:
+                delivery.add_done_callback(lambda _: export_file.close())
+    except Exception as e:
+        print(f"Error in export_campaign: {e}")
+        traceback.print_exc()
+        await send_message(ctx, "An error occurred while exporting the campaign. Please try again.")
+
+@bot.command()
+async def rules(ctx, *, query: str):
+    try:
+        matches, exact = get_rules_index().lookup(query)
+        if not matches:
+            await send_message(ctx, f"No rules entry found for '{query}'.")
+            return
+        if not exact:
+            await send_message(ctx, "No exact entry; did you mean " + ", ".join(f"{name} ({label})" for name, label, _ in matches) + "?")
+            return
+
+        name, label, text = matches[0]
+        rules_text = f"{name} ({label}):\n{text}"
+        if len(matches) > 1:
+            rules_text += "\n\nSee also: " + ", ".join(f"{other_name} ({other_label})" for other_name, other_label, _ in matches[1:])
+        await send_message(ctx, rules_text)
+    except Exception as e:
+        print(f"Error in rules: {e}")
+        traceback.print_exc()
+        await send_message(ctx, "An error occurred while looking up the rules. Please try again.")
 
-    current_progress_summary = progress_summary.get(channel_id, [])
-    if current_progress_summary:
-        summary_text = "Progress Summary:\n\n" + "\n".join(current_progress_summary)
-        await send_split_message(ctx, summary_text)
+@bot.command(name="update_rules_injection")
+async def update_rules_injection(ctx, setting: str):
+    channel_id = ctx.channel.id
+    if setting.lower() in ("on", "true", "yes"):
+        rules_injection[channel_id] = True
+        await send_message(ctx, "Matching SRD rules will now be passed to the DM with each message.")
+    elif setting.lower() in ("off", "false", "no"):
+        rules_injection[channel_id] = False
+        await send_message(ctx, "SRD rules will no longer be passed to the DM.")
     else:
-        await ctx.send("No progress summary found for this channel.")
+        await send_message(ctx, "Invalid setting. Please use on or off.")
 
 #System commands
 
 @bot.event
 async def on_ready():
     print(f"{bot.user.name} is ready!")
+    await start_metrics_server(metrics_port)
     bot.loop.create_task(periodic_save())
 
+@bot.before_invoke
+async def load_channel_for_command(ctx):
+    # Commands change the channel's state in place, so it has to be fully loaded first or save_data would have nothing to write.
+    ensure_channel_loaded(ctx.channel.id)
+
+@bot.after_invoke
+async def mark_channel_dirty(ctx):
+    # Any command may have changed the channel's state. load_channel_for_command has already loaded it, so the flush can save it.
+    dirty_channels.add(ctx.channel.id)
+
 @bot.command(name="update_chatbot_name")
 async def update_chatbot_name_command(ctx, *args):
     new_name = " ".join(args)
     channel_id = ctx.channel.id
     chatbot_name[channel_id] = new_name
-    await ctx.send(f"Chatbot name updated to: {new_name}")
+    await send_message(ctx, f"Chatbot name updated to: {new_name}", ack=True)
 
 @bot.command()
 async def update_priming_prompt(ctx, *, new_prompt: str):
@@ -696,14 +1508,14 @@ async def update_priming_prompt(ctx, *, new_prompt: str):
         # Check if the new_prompt is under the max_user_prompt limit
         prompt_length = num_tokens_from_string(new_prompt, "cl100k_base")
         if prompt_length > max_user_prompt:
-            await ctx.send("Please try again with a shorter priming prompt.")
+            await send_message(ctx, "Please try again with a shorter priming prompt.")
             return
 
         priming_prompt_base[channel_id] = formatted_prompt
-        await ctx.send(f"Priming prompt updated:\n{priming_prompt_base[channel_id]}")
+        await send_message(ctx, f"Priming prompt updated:\n{priming_prompt_base[channel_id]}")
     except Exception as e:
         print(f"Error in update_priming_prompt: {e}")
-        await ctx.send("An error occurred while updating the priming prompt. Please try again.")
+        await send_message(ctx, "An error occurred while updating the priming prompt. Please try again.")
 
 
 @bot.command()
@@ -714,10 +1526,19 @@ async def display_priming_prompt(ctx):
         if channel_id not in priming_prompt:
             priming_prompt_base[channel_id] = default_priming_prompt_base
 
-        await ctx.send(f"Current priming prompt:\n{priming_prompt_base[channel_id]}")
+        await send_message(ctx, f"Current priming prompt:\n{priming_prompt_base[channel_id]}")
     except Exception as e:
         print(f"Error in display_priming_prompt: {e}")
-        await ctx.send("An error occurred while displaying the priming prompt. Please try again.")
+        await send_message(ctx, "An error occurred while displaying the priming prompt. Please try again.")
+
+@bot.command(name="update_prompt_layout")
+async def update_prompt_layout(ctx, layout: str):
+    channel_id = ctx.channel.id
+    if layout.lower() in ("stable", "classic"):
+        prompt_layout[channel_id] = layout.lower()
+        await send_message(ctx, f"Prompt layout updated to {layout.lower()}.", ack=True)
+    else:
+        await send_message(ctx, "Invalid layout. Please use stable or classic.")
 
 @bot.command(name="update_temperature")
 async def update_temperature(ctx, new_temperature: float):
@@ -727,9 +1548,9 @@ async def update_temperature(ctx, new_temperature: float):
         temperature[channel_id] = 0.8
     if 0 <= new_temperature <= 1:
         temperature[channel_id] = new_temperature
-        await ctx.send(f"The chatbot temperature has been updated to {temperature[channel_id]:.2f}.")
+        await send_message(ctx, f"The chatbot temperature has been updated to {temperature[channel_id]:.2f}.", ack=True)
     else:
-        await ctx.send("Invalid temperature value. Please provide a value between 0 and 1.")
+        await send_message(ctx, "Invalid temperature value. Please provide a value between 0 and 1.")
 
 @bot.command()
 async def clear_chat_history(ctx):
@@ -739,14 +1560,40 @@ async def clear_chat_history(ctx):
         if channel_id not in chat_history:
             chat_history[channel_id] = []
         chat_history[channel_id] = []
-        await ctx.send("Chat history has been cleared.")
+        await send_message(ctx, "Chat history has been cleared.", ack=True)
     except Exception as e:
         traceback.print_exc()
         print(f"Error in clear_chat_history: {e}")
-        await ctx.send("An error occurred while clearing the chat history. Please try again.")
+        await send_message(ctx, "An error occurred while clearing the chat history. Please try again.")
 
 @bot.command(name="dm")
 async def chat(ctx, *, message):
+    await run_dm_turn(ctx, message)
+
+async def run_dm_turn(ctx, message):
+
+    #The body of !dm. It only needs ctx.channel.id, ctx.author.id, ctx.author.name and an async ctx.send(), so it can be run headlessly with a fake context.
+    #Logs one JSON line per turn with the time spent in each stage. Returns the delivery future of the DM's reply (None if there
+    #wasn't one), which resolves to True once Discord has accepted the message.
+    if shutting_down:
+        await send_message(ctx, "The DM is restarting. Please try again in a moment.")
+        return
+
+    turn_task = asyncio.current_task()
+    in_flight_turns.add(turn_task)
+    last_active[ctx.channel.id] = time.time()
+    spans = {"event": "turn", "channel": ctx.channel.id, "user": ctx.author.id}
+    spans_token = current_turn_spans.set(spans)
+    try:
+        with timed_stage("turn", cpu=False):
+            return await play_dm_turn(ctx, message)
+    finally:
+        current_turn_spans.reset(spans_token)
+        in_flight_turns.discard(turn_task)
+        dirty_channels.add(ctx.channel.id)
+        print(json.dumps(spans))
+
+async def play_dm_turn(ctx, message):
     global chatbot_name, chat_history
     channel_id = ctx.channel.id
     if channel_id not in chatbot_name:
@@ -775,43 +1622,136 @@ async def chat(ctx, *, message):
         # Check if the message is under 500 tokens
         message_length = num_tokens_from_string(message, "cl100k_base")
         if message_length > max_user_prompt:
-            await ctx.send("Please try again with a shorter message.")
+            await send_message(ctx, "Please try again with a shorter message.")
             return
 
         # Update chat history
         chat_history[channel_id].append({"role": "user", "content": f"{username}: {message}"})
 
         prompt = f"You are the Dungeon Master. Respond to this player: '{message}'"
+        if rules_injection.get(channel_id):
+            rules_excerpts = get_rules_index().find_mentions(message)
+            if rules_excerpts:
+                prompt += "\n\nRules reference (5e SRD):\n" + "\n".join(f"{name} ({label}): {text}" for name, label, text in rules_excerpts)
         response = await generate_response(prompt, channel_id)
         # Update chat history with the model's response
         chat_history[channel_id].append({"role": "assistant", "content": f"{chatbot_name[channel_id]}: {response}"})
-        await send_split_message(ctx, response)
+        delivery = await send_message(ctx, response)
 
         # Generate progress summary update
-        progress_summary_update = await generate_progress_summary(chat_history, progress_summary, channel_id, is_progress_summary=True)
+        with timed_stage("progress_summary", cpu=False):
+            progress_summary_update = await generate_progress_summary(chat_history, progress_summary, channel_id, is_progress_summary=True)
         # If the progress summary update contains "Completed:", update the progress_summary
         print(f"Progress summary update: {progress_summary_update}")
         if progress_summary_update.startswith("Completed:"):
             new_events = progress_summary_update[len("Completed:"):].strip().split(", ")
             progress_summary[channel_id].extend(new_events)
-            save_data(channel_id)
+            with timed_stage("save_data"):
+                save_data(channel_id)
+        return delivery
 
     except Exception as e:
         print(f"Error in chat: {e}")
         traceback.print_exc()
-        await ctx.send("An error occurred while processing your message. Please try again.")
+        await send_message(ctx, "An error occurred while processing your message. Please try again.")
 
 @bot.command(name="clear_save")
 async def clear_save_command(ctx):
     channel_id = ctx.channel.id
     clear_save(channel_id)
-    await ctx.send("Saved data for this channel has been cleared.")
+    await send_message(ctx, "Saved data for this channel has been cleared.")
 
 @bot.command(name="save_game")
 async def save_game_command(ctx):
     channel_id = ctx.channel.id
     save_data(channel_id)
-    await ctx.send("Game data saved successfully.")
+    await send_message(ctx, "Game data saved successfully.", ack=True)
+
+def is_admin(ctx):
+    permissions = getattr(ctx.author, "guild_permissions", None)
+    return permissions is not None and permissions.administrator
+
+@bot.command(name="stats")
+async def stats_command(ctx):
+    if not is_admin(ctx):
+        await send_message(ctx, "Only server administrators can use this command.")
+        return
+
+    channel_id = ctx.channel.id
+    with stage_totals_lock:
+        latencies = {stage: list(values) for stage, values in stage_latencies.items()}
+    stage_lines = [
+        f"{stage}: p50 {percentile(values, 0.5) * 1000:.0f} ms, p95 {percentile(values, 0.95) * 1000:.0f} ms, p99 {percentile(values, 0.99) * 1000:.0f} ms ({len(values)} samples)"
+        for stage, values in sorted(latencies.items())
+    ]
+    total_input, total_output = token_counts.get(channel_id, [0, 0])
+    queue_stats = outbound_queue.stats()
+    overlaps = list(prefix_overlaps)
+    overlap_text = f"{sum(overlaps) / len(overlaps):.0%} on average, {percentile(overlaps, 0.5):.0%} median ({prompt_layout.get(channel_id, 'stable')} layout here)" if overlaps else "no repeat prompts yet"
+    profiling = f"every {profile_sample_every} OpenAI calls, {profile_samples} samples so far" if profile_sample_every else "off"
+    await send_message(ctx, (
+        "Stage latency:\n" + ("\n".join(stage_lines) if stage_lines else "No turns yet.") + "\n\n"
+        f"Tokens for this channel: {input_tokens.get(channel_id, 0)} in the last prompt, {total_input} in and {total_output} out in total\n"
+        f"Prompt prefix shared with the previous request: {overlap_text}\n"
+        f"Messages sent: {queue_stats['messages_sent']}, rate limited: {queue_stats['rate_limited']}, waiting: {queue_stats['queued']}\n"
+        f"Profiling: {profiling}"
+    ))
+
+@bot.command(name="profile")
+async def profile_command(ctx, action: str = "status", sample_every: int = 10):
+    global profile_sample_every, profile_calls_seen, profile_samples, profile_stats
+    if not is_admin(ctx):
+        await send_message(ctx, "Only server administrators can use this command.")
+        return
+
+    try:
+        if action.lower() == "start":
+            if sample_every < 1:
+                await send_message(ctx, "Please provide a sample rate of 1 or more.")
+                return
+            profile_calls_seen = itertools.count(1)
+            profile_samples = 0
+            profile_stats = None
+            profile_sample_every = sample_every
+            await send_message(ctx, f"Profiling 1 in every {sample_every} OpenAI calls. Use !profile stop to see the results.")
+        elif action.lower() == "stop":
+            profile_sample_every = 0
+            # A sample may still be running in another thread, so wait for it without blocking the event loop.
+            await asyncio.to_thread(profile_lock.acquire)
+            try:
+                stats, samples = profile_stats, profile_samples
+                profile_stats = None
+            finally:
+                profile_lock.release()
+            if stats is None:
+                await send_message(ctx, "Profiling stopped. No samples were captured.")
+                return
+            PROFILE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+            profile_file = PROFILE_DIRECTORY / f"profile_{int(time.time())}.prof"
+            stats.dump_stats(profile_file)
+            output = io.StringIO()
+            stats.stream = output
+            stats.sort_stats("cumulative").print_stats(15)
+            await send_message(ctx, f"Profiling stopped. {samples} samples saved to {profile_file}.\n{output.getvalue()[:3500]}")
+        else:
+            if profile_sample_every:
+                await send_message(ctx, f"Profiling 1 in every {profile_sample_every} OpenAI calls, {profile_samples} samples so far.")
+            else:
+                await send_message(ctx, "Profiling is off. Use !profile start [sample_every] to turn it on.")
+    except Exception as e:
+        print(f"Error in profile: {e}")
+        traceback.print_exc()
+        await send_message(ctx, "An error occurred while profiling. Please try again.")
+
+@bot.command(name="queue_stats")
+async def queue_stats_command(ctx):
+    stats = outbound_queue.stats()
+    await send_message(ctx, (
+        f"Messages sent: {stats['messages_sent']}\n"
+        f"Rate limited (429) responses: {stats['rate_limited']}\n"
+        f"Messages waiting: {stats['queued']}\n"
+        f"Send latency p50: {stats['latency_p50_ms']:.0f} ms, p95: {stats['latency_p95_ms']:.0f} ms"
+    ))
 
 # Remove the default help command
 bot.remove_command('help')
@@ -820,10 +1760,123 @@ bot.remove_command('help')
 @bot.command()
 async def help(ctx):
     try:
-        await send_split_message(ctx, help_message)
+        await send_message(ctx, help_message)
     except Exception as e:
         traceback.print_exc()
-        await ctx.send(f"Error: {str(e)}")
-
+        await send_message(ctx, f"Error: {str(e)}")
+
+#Sharded deployment. Each worker process owns a subset of the Discord shards, and with them every guild and channel routed to those shards.
+#Channel state, chat history and save_data/data_{channel_id}.json files therefore only ever live in one process, so the workers never need to share them.
+
+def shard_groups(processes, shard_count):
+    #Deals shards out round-robin, so worker i owns shards i, i + processes, i + 2 * processes and so on.
+    return [list(range(shard_count))[index::processes] for index in range(processes)]
+
+def shard_for_guild(guild_id, shard_count):
+    #Discord's own formula for which shard a guild's events arrive on.
+    return (guild_id >> 22) % shard_count
+
+def configure_worker(shard_ids, shard_count, budget):
+    global openai_budget, metrics_port, warm_snapshot_name
+    openai_budget = budget
+    if metrics_port and shard_ids:
+        # Each worker gets its own port: the first shard in each group is the worker's index.
+        metrics_port += shard_ids[0]
+    if shard_ids:
+        warm_snapshot_name = f"warm_snapshot_{shard_ids[0]}.json"
+    bot.shard_ids = shard_ids
+    bot.shard_count = shard_count
+
+def run_worker(shard_ids, shard_count, budget):
+    configure_worker(shard_ids, shard_count, budget)
+    discord.utils.setup_logging()
+    asyncio.run(run_bot(config.get("API_KEYS", "DISCORD_TOKEN")))
+
+async def run_bot(token):
+
+    #Like bot.run, but SIGINT and SIGTERM trigger graceful_shutdown instead of dropping unsaved state.
+    loop = asyncio.get_running_loop()
+    for shutdown_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(shutdown_signal, lambda: asyncio.create_task(graceful_shutdown()))
+        except NotImplementedError:
+            pass  # Not supported on Windows, where Ctrl+C still stops the bot without the final flush.
+    load_warm_snapshot()
+    async with bot:
+        await bot.start(token)
+
+def supervise(processes, shard_count, budget, worker_target=run_worker, restart_delay=5, max_restart_delay=300, poll_interval=1):
+
+    #Starts one worker per shard group and restarts any that die, backing off if a worker keeps crashing straight after start-up.
+    #worker_target is called as worker_target(shard_ids, shard_count, budget), so a fake gateway worker can be swapped in for testing
+    #(see benchmark.fake_gateway_worker). Returns once every worker has exited cleanly.
+    groups = shard_groups(processes, shard_count)
+    workers = {}
+    delays = {}
+    restart_at = {}
+
+    def start_worker(index):
+        process = multiprocessing.Process(target=worker_target, args=(groups[index], shard_count, budget), name=f"shard-worker-{index}")
+        process.start()
+        workers[index] = (process, time.time())
+        print(f"Started worker {index} (pid {process.pid}) for shards {groups[index]}")
+
+    def stop_supervisor(signum, frame):
+        raise KeyboardInterrupt
+
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, stop_supervisor)
+    for index in range(processes):
+        start_worker(index)
 
-bot.run(config.get("API_KEYS", "DISCORD_TOKEN"))
+    try:
+        while workers or restart_at:
+            time.sleep(poll_interval)
+            for index, (process, started) in list(workers.items()):
+                if process.is_alive():
+                    continue
+                del workers[index]
+                freed = budget.reclaim(process.pid)
+                if freed:
+                    print(f"Reclaimed {freed} OpenAI budget slots from worker {index}.")
+                if process.exitcode == 0:
+                    print(f"Worker {index} exited cleanly.")
+                    continue
+                if time.time() - started > 60:
+                    delays[index] = restart_delay
+                else:
+                    delays[index] = min(max_restart_delay, delays.get(index, restart_delay / 2) * 2)
+                restart_at[index] = time.time() + delays[index]
+                print(f"Worker {index} exited with code {process.exitcode}. Restarting in {delays[index]:.0f} seconds.")
+            for index, when in list(restart_at.items()):
+                if time.time() >= when:
+                    del restart_at[index]
+                    start_worker(index)
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+    finally:
+        # terminate() sends SIGTERM, so each worker gets to flush its state before exiting. They all shut down at once, so they
+        # share one deadline rather than each getting a fresh timeout.
+        for process, _ in workers.values():
+            process.terminate()
+        kill_at = time.time() + SHUTDOWN_TIMEOUT + SHUTDOWN_KILL_GRACE
+        for process, _ in workers.values():
+            process.join(max(0, kill_at - time.time()))
+            if process.is_alive():
+                process.kill()
+        signal.signal(signal.SIGTERM, previous_sigterm_handler)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the DungeonMasterGPT Discord bot.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes. More than 1 runs a supervisor that shards guilds across workers.")
+    parser.add_argument("--shard-count", type=int, default=None, help="Total number of Discord shards. Defaults to Discord's recommendation, or to --processes when sharding.")
+    parser.add_argument("--max-concurrent-openai-calls", type=int, default=8, help="OpenAI calls allowed in flight at once, across all workers.")
+    parser.add_argument("--openai-calls-per-minute", type=int, default=3500, help="OpenAI calls allowed per minute, across all workers.")
+    args = parser.parse_args()
+    if args.shard_count is not None and args.shard_count < args.processes:
+        parser.error("--shard-count must be at least --processes.")
+
+    budget = OpenAIBudget(args.max_concurrent_openai_calls, args.openai_calls_per_minute)
+    if args.processes > 1:
+        supervise(args.processes, args.shard_count or args.processes, budget)
+    else:
+        run_worker(None, args.shard_count, budget)
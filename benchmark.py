@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import types
+
+import DungeonMasterGPT as dm
+
+# Headless load test for the !dm turn. Replays recorded or synthetic sessions across N channels at once, using a
+# deterministic fake OpenAI backend and fake Discord contexts, and reports throughput, turn latency, reply delivery
+# latency through the outbound queue, tokens per turn and CPU time per stage. Nothing here talks to Discord or OpenAI.
+#
+#   python benchmark.py --channels 20 --turns 10 --latency 0.5
+#   python benchmark.py --replay save_data/data_1234.json --channels 5 --json
+
+synthetic_player_messages = [
+    "I push open the tavern door and look around for the innkeeper.",
+    "I ask the innkeeper if he has heard any rumours about the cult.",
+    "I draw my sword and step between the merchant and the thugs.",
+    "I cast Magic Missile at the nearest goblin.",
+    "I search the room for traps before we go any further.",
+    "We follow the tracks into the forest, keeping to the shadows.",
+    "I try to pick the lock on the iron chest.",
+    "I offer the guard five gold pieces to look the other way.",
+    "I climb the ruined tower to get a better view of the valley.",
+    "We set up camp and take a long rest.",
+]
+
+fake_dm_responses = [
+    "The door creaks open onto a smoky common room. A dwarf polishes tankards behind the bar and eyes you warily.",
+    "The innkeeper leans closer. \"Folk have been going missing near the old mill,\" he mutters. \"Hooded figures, every new moon.\"",
+    "Steel rings as the thugs draw daggers of their own. Roll for initiative! The merchant scrambles behind a cart.",
+    "Three glowing darts streak from your fingertips and slam into the goblin. It crumples without a sound.",
+    "Make a Wisdom (Perception) check. Beneath a loose flagstone you spot a thin wire stretched across the threshold.",
+    "The tracks lead deeper under the canopy. Somewhere ahead, a twig snaps. You are not alone.",
+    "Make a Dexterity check with your thieves' tools. The mechanism is old but well oiled.",
+    "The guard glances over his shoulder, pockets the coins and steps aside. \"I never saw you.\"",
+    "From the top of the tower the whole valley spreads out below. Smoke rises from a camp to the north.",
+    "The night passes quietly. You wake refreshed, regaining all hit points and spent spell slots.",
+]
+
+class FakeCompletionBackend:
+
+    #Stands in for openai.ChatCompletion.create. Responses depend only on the seed and the prompt, so runs are repeatable.
+    def __init__(self, latency=0.5, jitter=0.0, seed=0, summary_every=3):
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.summary_every = summary_every
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.response_tokens = [dm.num_tokens_from_string(text, "cl100k_base") for text in fake_dm_responses]
+
+    def __call__(self, model, messages, max_tokens, n, stop, temperature):
+        prompt = messages[-1]["content"]
+        rng = random.Random(f"{self.seed}:{len(messages)}:{prompt}")
+        with self.lock:
+            self.calls += 1
+            call_number = self.calls
+        time.sleep(self.latency + rng.uniform(0, self.jitter))
+
+        if prompt.startswith("Have any key events occurred"):
+            if call_number % self.summary_every == 0:
+                content = f"Completed: Event {call_number}"
+            else:
+                content = "No new events."
+            completion_tokens = len(content.split())
+        else:
+            index = rng.randrange(len(fake_dm_responses))
+            content = fake_dm_responses[index]
+            completion_tokens = self.response_tokens[index]
+        return {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": {"completion_tokens": completion_tokens},
+        }
+
+class FakeContext:
+
+    #Just enough of a discord.py Context for run_dm_turn and the outbound queue.
+    def __init__(self, channel_id, author_id, author_name, send_latency=0.0):
+        self.channel = types.SimpleNamespace(id=channel_id)
+        self.author = types.SimpleNamespace(id=author_id, name=author_name)
+        self.guild = None
+        self.send_latency = send_latency
+        self.sent = []
+
+    async def send(self, content, file=None):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append(content)
+        if file is not None:
+            file.close()
+
+def load_session(path):
+
+    #Accepts a save_data/data_{channel_id}.json file (player lines are pulled out of its chat history) or a JSON list of player messages.
+    with open(path, "r") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        session = []
+        for entry in data.get("chat_history", []):
+            if entry.get("role") == "user":
+                _, _, message = entry["content"].partition(": ")
+                session.append(message or entry["content"])
+        return session
+    return [str(message) for message in data]
+
+def synthetic_session(turns, seed):
+    rng = random.Random(seed)
+    return [rng.choice(synthetic_player_messages) for _ in range(turns)]
+
+async def run_channel(channel_id, session, latencies, reply_latencies, players, send_latency):
+    contexts = [FakeContext(channel_id, channel_id * 10 + player, f"Player{player}", send_latency) for player in range(players)]
+    for turn, message in enumerate(session):
+        ctx = contexts[turn % players]
+        started = time.perf_counter()
+        delivery = await dm.run_dm_turn(ctx, message)
+        latencies.append(time.perf_counter() - started)
+        # Players wait to read the reply before the next message, so the next turn starts once Discord has it.
+        if delivery is not None and await delivery:
+            reply_latencies.append(time.perf_counter() - started)
+
+async def run_benchmark(sessions, players, threads, send_latency):
+    asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=threads))
+    latencies = []
+    reply_latencies = []
+    await asyncio.gather(*(
+        run_channel(channel_id, session, latencies, reply_latencies, players, send_latency)
+        for channel_id, session in sessions.items()
+    ))
+    # Anything still queued would be cancelled when asyncio.run returns.
+    await dm.outbound_queue.flush()
+    return latencies, reply_latencies
+
+def guild_for_channel(channel_id):
+    #Fake guild snowflake for each benchmark channel. Shifting by 22 bits spreads consecutive channels evenly over the shards.
+    return channel_id << 22
+
+def play_sessions(sessions, args):
+
+    #Plays the sessions in this process and returns the raw numbers for the report, so worker processes can hand theirs back.
+    dm.completion_backend = FakeCompletionBackend(args.latency, args.jitter, args.seed)
+    for channel_id in sessions:
+        dm.prompt_layout[channel_id] = args.prompt_layout
+
+    cpu_start = time.process_time()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        latencies, reply_latencies = asyncio.run(run_benchmark(sessions, args.players, args.threads, args.send_latency))
+    return {
+        "latencies": latencies,
+        "reply_latencies": reply_latencies,
+        "send_latencies": list(dm.outbound_queue.send_latencies),
+        "messages_sent": dm.outbound_queue.messages_sent,
+        "rate_limited": dm.outbound_queue.rate_limited,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "input_tokens": sum(counts[0] for counts in dm.token_counts.values()),
+        "output_tokens": sum(counts[1] for counts in dm.token_counts.values()),
+        "prefix_overlaps": list(dm.prefix_overlaps),
+        "stages": {stage: list(totals) for stage, totals in dm.stage_totals.items()},
+    }
+
+def fake_gateway_worker(shard_ids, shard_count, budget, sessions, args, results_directory):
+
+    #Drop-in worker_target for dm.supervise. Rather than connecting to Discord, it delivers the sessions of every guild on the
+    #shards this worker owns, exactly as the gateway would, and writes its numbers to results_directory for the parent.
+    dm.configure_worker(shard_ids, shard_count, budget)
+    dm.SAVE_DATA_DIRECTORY = dm.pathlib.Path(results_directory)
+    owned = {
+        channel_id: session for channel_id, session in sessions.items()
+        if dm.shard_for_guild(guild_for_channel(channel_id), shard_count) in shard_ids
+    }
+    results = play_sessions(owned, args)
+    results["shard_ids"] = shard_ids
+    results["channels"] = sorted(owned)
+    with open(os.path.join(results_directory, f"results_{shard_ids[0]}.json"), "w") as f:
+        json.dump(results, f)
+
+def combine_results(worker_results):
+    combined = {
+        "latencies": [], "reply_latencies": [], "send_latencies": [], "messages_sent": 0, "rate_limited": 0,
+        "cpu_seconds": 0.0, "input_tokens": 0, "output_tokens": 0, "prefix_overlaps": [], "stages": {},
+    }
+    for results in worker_results:
+        for key in ("latencies", "reply_latencies", "send_latencies", "prefix_overlaps"):
+            combined[key] += results[key]
+        for key in ("messages_sent", "rate_limited", "cpu_seconds", "input_tokens", "output_tokens"):
+            combined[key] += results[key]
+        for stage, (count, wall, cpu) in results["stages"].items():
+            combined_count, combined_wall, combined_cpu = combined["stages"].get(stage, [0, 0.0, None if cpu is None else 0.0])
+            combined["stages"][stage] = [combined_count + count, combined_wall + wall, None if cpu is None else combined_cpu + cpu]
+    return combined
+
+def run_sharded(sessions, args, save_directory):
+    budget = dm.OpenAIBudget(max_concurrent=args.threads, calls_per_minute=10 ** 9)
+    worker_target = functools.partial(fake_gateway_worker, sessions=sessions, args=args, results_directory=save_directory)
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        dm.supervise(args.processes, args.shard_count or args.processes, budget, worker_target=worker_target, restart_delay=1, poll_interval=0.1)
+    worker_results = []
+    for path in sorted(glob.glob(os.path.join(save_directory, "results_*.json"))):
+        with open(path, "r") as f:
+            worker_results.append(json.load(f))
+    return combine_results(worker_results)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Replay DungeonMasterGPT sessions headlessly and report performance.")
+    parser.add_argument("--channels", type=int, default=10, help="Number of channels to run at once.")
+    parser.add_argument("--turns", type=int, default=10, help="Turns per channel for synthetic sessions.")
+    parser.add_argument("--players", type=int, default=3, help="Players taking turns in each channel.")
+    parser.add_argument("--replay", help="Session to replay in every channel instead of a synthetic one.")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake OpenAI latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random fake OpenAI latency, up to this many seconds.")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="Fake Discord send latency in seconds.")
+    parser.add_argument("--threads", type=int, default=32, help="Worker threads available for OpenAI calls. Shared across processes.")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes. More than 1 runs the supervisor with a fake gateway in each worker.")
+    parser.add_argument("--shard-count", type=int, default=None, help="Total number of shards when running several processes. Defaults to --processes.")
+    parser.add_argument("--prompt-layout", choices=("stable", "classic"), default="stable", help="Prompt layout to use in every channel.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own logging.")
+    return parser
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.shard_count is not None and args.shard_count < args.processes:
+        parser.error("--shard-count must be at least --processes.")
+
+    if args.replay:
+        session = load_session(args.replay)
+        sessions = {1000 + index: session for index in range(args.channels)}
+    else:
+        sessions = {1000 + index: synthetic_session(args.turns, f"{args.seed}:{index}") for index in range(args.channels)}
+
+    with tempfile.TemporaryDirectory() as save_directory:
+        dm.SAVE_DATA_DIRECTORY = dm.pathlib.Path(save_directory)
+        wall_start = time.perf_counter()
+        if args.processes > 1:
+            results = run_sharded(sessions, args, save_directory)
+        else:
+            dm.openai_budget = dm.OpenAIBudget(max_concurrent=args.threads, calls_per_minute=10 ** 9)
+            results = play_sessions(sessions, args)
+        wall = time.perf_counter() - wall_start
+
+    latencies = results["latencies"]
+    turns = len(latencies)
+    cpu = results["cpu_seconds"]
+    report = {
+        "channels": len(sessions),
+        "processes": args.processes,
+        "turns": turns,
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "turns_per_second": turns / wall if wall else 0.0,
+        "latency_p50_ms": dm.percentile(latencies, 0.5) * 1000,
+        "latency_p95_ms": dm.percentile(latencies, 0.95) * 1000,
+        "latency_p99_ms": dm.percentile(latencies, 0.99) * 1000,
+        "reply_latency_p50_ms": dm.percentile(results["reply_latencies"], 0.5) * 1000,
+        "reply_latency_p95_ms": dm.percentile(results["reply_latencies"], 0.95) * 1000,
+        "messages_sent": results["messages_sent"],
+        "rate_limited": results["rate_limited"],
+        "send_latency_p50_ms": dm.percentile(results["send_latencies"], 0.5) * 1000,
+        "send_latency_p95_ms": dm.percentile(results["send_latencies"], 0.95) * 1000,
+        "input_tokens_per_turn": results["input_tokens"] / turns if turns else 0.0,
+        "output_tokens_per_turn": results["output_tokens"] / turns if turns else 0.0,
+        "prefix_overlap_mean": sum(results["prefix_overlaps"]) / len(results["prefix_overlaps"]) if results["prefix_overlaps"] else 0.0,
+        # Stages that await (turn, progress_summary) are timed as wall clock only, so their CPU figures are None.
+        "stages": {
+            stage: {
+                "count": count,
+                "wall_ms": stage_wall * 1000,
+                "cpu_ms": None if stage_cpu is None else stage_cpu * 1000,
+                "cpu_ms_per_turn": None if stage_cpu is None else stage_cpu * 1000 / turns if turns else 0.0,
+            }
+            for stage, (count, stage_wall, stage_cpu) in sorted(results["stages"].items())
+        },
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['turns']} turns across {report['channels']} channels and {report['processes']} processes in {wall:.2f}s ({report['turns_per_second']:.1f} turns/s, {cpu:.2f}s CPU)")
+    print(f"Turn latency p50 {report['latency_p50_ms']:.0f} ms, p95 {report['latency_p95_ms']:.0f} ms, p99 {report['latency_p99_ms']:.0f} ms")
+    print(f"Reply delivered p50 {report['reply_latency_p50_ms']:.0f} ms, p95 {report['reply_latency_p95_ms']:.0f} ms after the player's message")
+    print(f"Outbound queue: {report['messages_sent']} messages sent, {report['rate_limited']} rate limited, queue to delivery p50 {report['send_latency_p50_ms']:.0f} ms, p95 {report['send_latency_p95_ms']:.0f} ms")
+    print(f"Tokens per turn: {report['input_tokens_per_turn']:.0f} in, {report['output_tokens_per_turn']:.0f} out")
+    print(f"Prompt prefix shared with the previous request: {report['prefix_overlap_mean']:.0%} on average")
+    print("CPU time per stage (ms per turn):")
+    for stage, totals in report["stages"].items():
+        cpu_text = "    wall" if totals["cpu_ms_per_turn"] is None else f"{totals['cpu_ms_per_turn']:8.2f}"
+        print(f"  {stage:<17}{cpu_text}   ({totals['count']} calls, {totals['wall_ms']:.0f} ms wall total)")
+    print("Stages marked wall await other work, so only their wall clock time is measured.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# DungeonMasterGPT.py is a single module at the repo root rather than an installed package.
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
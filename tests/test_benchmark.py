@@ -0,0 +1,19 @@
+import benchmark
+import DungeonMasterGPT as dm
+
+
+def test_reply_latency_waits_for_discord_delivery(tmp_path, monkeypatch):
+    monkeypatch.setattr(dm, "SAVE_DATA_DIRECTORY", tmp_path)
+    monkeypatch.setattr(dm, "completion_backend", dm.completion_backend)
+    monkeypatch.setattr(dm, "outbound_queue", dm.OutboundQueue())
+    args = benchmark.build_parser().parse_args(["--latency", "0", "--send-latency", "0.05", "--threads", "4"])
+    sessions = {2000 + index: benchmark.synthetic_session(3, index) for index in range(2)}
+
+    results = benchmark.play_sessions(sessions, args)
+
+    assert len(results["latencies"]) == 6
+    assert len(results["reply_latencies"]) == 6
+    assert min(results["reply_latencies"]) >= 0.05
+    assert results["messages_sent"] == 6
+    assert min(results["send_latencies"]) >= 0.05
+    assert dm.outbound_queue.stats()["queued"] == 0
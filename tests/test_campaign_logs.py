@@ -0,0 +1,84 @@
+import asyncio
+import gzip
+import tempfile
+import types
+
+import pytest
+
+import DungeonMasterGPT as dm
+
+
+class FakeContext:
+
+    #Keeps hold of any attachment, and reads it the way discord.py would when uploading.
+    def __init__(self, channel_id):
+        self.channel = types.SimpleNamespace(id=channel_id)
+        self.guild = None
+        self.sent = []
+        self.files = []
+        self.uploads = []
+
+    async def send(self, content, file=None):
+        self.sent.append(content)
+        if file is not None:
+            self.files.append(file)
+            self.uploads.append(file.fp.read())
+            file.close()
+
+
+@pytest.fixture
+def channel(tmp_path, monkeypatch):
+    monkeypatch.setattr(dm, "SAVE_DATA_DIRECTORY", tmp_path)
+    monkeypatch.setattr(dm, "outbound_queue", dm.OutboundQueue(rate=100, per=0.01))
+    monkeypatch.setattr(dm, "log_page_index", {})
+    channel_id = 3000
+    monkeypatch.setitem(dm.campaign_overview, channel_id, "The cult of the old mill")
+    monkeypatch.setitem(dm.progress_summary, channel_id, ["Met the innkeeper", "Found the hidden door"])
+    monkeypatch.setitem(dm.characters, channel_id, {})
+    monkeypatch.setitem(dm.chat_history, channel_id, [{"role": "user", "content": f"Player0: Message {index}"} for index in range(50)])
+    monkeypatch.setitem(dm.priming_prompt_base, channel_id, dm.default_priming_prompt_base)
+    monkeypatch.setitem(dm.summary_priming_prompt, channel_id, dm.default_summary_priming_prompt)
+    return channel_id
+
+
+def test_export_uploads_a_real_file_and_closes_it_after_delivery(channel):
+    ctx = FakeContext(channel)
+
+    async def scenario():
+        await dm.export_campaign.callback(ctx)
+        await dm.outbound_queue.flush()
+
+    asyncio.run(scenario())
+
+    assert len(ctx.files) == 1
+    attachment = ctx.files[0]
+    # discord.File only treats io.IOBase objects as files before Python 3.11, which rules out SpooledTemporaryFile.
+    assert not isinstance(attachment.fp, tempfile.SpooledTemporaryFile)
+    assert attachment.filename == f"campaign_{channel}.txt.gz"
+    transcript = gzip.decompress(ctx.uploads[0]).decode()
+    assert "The cult of the old mill" in transcript
+    assert "Message 49" in transcript
+    assert attachment.fp.closed
+
+
+def test_export_unwraps_the_temporary_file_wrapper_used_on_windows(channel, monkeypatch):
+    # On Windows tempfile.TemporaryFile is NamedTemporaryFile, which returns a wrapper rather than an io.IOBase.
+    wrappers = []
+
+    def named_temporary_file():
+        wrappers.append(tempfile.NamedTemporaryFile())
+        return wrappers[-1]
+
+    monkeypatch.setattr(dm.tempfile, "TemporaryFile", named_temporary_file)
+    ctx = FakeContext(channel)
+
+    async def scenario():
+        await dm.export_campaign.callback(ctx)
+        await dm.outbound_queue.flush()
+
+    asyncio.run(scenario())
+
+    assert len(ctx.files) == 1
+    assert ctx.files[0].fp is wrappers[0].file
+    assert "Message 49" in gzip.decompress(ctx.uploads[0]).decode()
+    assert wrappers[0].closed
@@ -0,0 +1,36 @@
+import pytest
+
+import DungeonMasterGPT as dm
+
+
+@pytest.fixture(autouse=True)
+def empty_index(monkeypatch):
+    monkeypatch.setattr(dm, "log_page_index", {})
+
+
+def page_offsets(entries):
+    return list(dm.log_page_offsets(1, "chat_history", entries, str))
+
+
+def test_pages_split_on_characters_and_entries():
+    assert page_offsets(["x" * 1000] * 4) == [0, 1, 2, 3]
+    assert page_offsets(["short"] * 60) == [0, 25, 50]
+
+
+def test_index_carries_on_as_the_log_grows():
+    entries = ["short"] * 30
+    assert page_offsets(entries) == [0, 25]
+
+    entries.extend(["short"] * 30)
+
+    assert page_offsets(entries) == [0, 25, 50]
+
+
+def test_replaced_log_is_reindexed_even_if_python_reuses_its_id():
+    for _ in range(20):
+        old_log = ["x" * 1000 for _ in range(4)]
+        assert page_offsets(old_log) == [0, 1, 2, 3]
+        del old_log
+        # A new list of the same length often lands on the freed list's memory, and so gets the same id().
+        new_log = ["y" for _ in range(4)]
+        assert page_offsets(new_log) == [0]
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import types
+
+import discord
+
+import DungeonMasterGPT as dm
+
+
+class TooManyRequests(Exception):
+
+    #Stands in for a discord.HTTPException with a 429 status.
+    def __init__(self, retry_after=0.0):
+        super().__init__("429 Too Many Requests")
+        self.status = 429
+        self.retry_after = retry_after
+
+
+class FakeTransport:
+
+    #Fake discord.py Context. Raises the queued failures in order before letting sends through.
+    def __init__(self, channel_id=1, failures=()):
+        self.channel = types.SimpleNamespace(id=channel_id)
+        self.failures = list(failures)
+        self.sent = []
+        self.attempts = 0
+
+    async def send(self, content, file=None):
+        self.attempts += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append(content)
+
+
+def fast_queue(**kwargs):
+    return dm.OutboundQueue(rate=kwargs.pop("rate", 100), per=kwargs.pop("per", 0.01), **kwargs)
+
+
+def test_split_message_keeps_parts_under_limit_and_prefers_paragraphs():
+    paragraphs = [("word " * 60).strip() + "." for _ in range(6)]
+    message = "\n\n".join(paragraphs)
+
+    parts = dm.split_message(message, 700)
+
+    assert all(len(part) <= 700 for part in parts)
+    assert all(part.endswith(".") for part in parts)
+    assert " ".join(" ".join(parts).split()) == " ".join(message.split())
+
+
+def test_split_message_hard_splits_text_without_breaks():
+    parts = dm.split_message("x" * 4500)
+
+    assert [len(part) for part in parts] == [2000, 2000, 500]
+
+
+def test_split_message_short_message_is_untouched():
+    assert dm.split_message("The door creaks open.") == ["The door creaks open."]
+
+
+def test_acks_waiting_together_are_coalesced():
+    async def scenario():
+        queue = fast_queue()
+        ctx = FakeTransport()
+        futures = [queue.enqueue(ctx, f"Ack {index}", ack=True) for index in range(3)]
+        futures.append(queue.enqueue(ctx, "The goblin flees.", ack=True))
+        futures.append(queue.enqueue(ctx, "A full DM reply."))
+        await queue.flush()
+        return ctx, queue, [future.result() for future in futures]
+
+    ctx, queue, results = asyncio.run(scenario())
+
+    assert ctx.sent == ["Ack 0\nAck 1\nAck 2\nThe goblin flees.", "A full DM reply."]
+    assert results == [True] * 5
+    assert queue.messages_sent == 2
+
+
+def test_regular_messages_are_never_coalesced():
+    async def scenario():
+        queue = fast_queue()
+        ctx = FakeTransport()
+        for index in range(3):
+            queue.enqueue(ctx, f"Reply {index}")
+        await queue.flush()
+        return ctx
+
+    assert asyncio.run(scenario()).sent == ["Reply 0", "Reply 1", "Reply 2"]
+
+
+def test_coalescing_stops_at_the_message_length_limit():
+    async def scenario():
+        queue = fast_queue(max_length=20)
+        ctx = FakeTransport()
+        for index in range(4):
+            queue.enqueue(ctx, f"Ack number {index}", ack=True)
+        await queue.flush()
+        return ctx
+
+    assert asyncio.run(scenario()).sent == ["Ack number 0", "Ack number 1", "Ack number 2", "Ack number 3"]
+
+
+def test_429_is_retried_and_counted():
+    async def scenario():
+        queue = fast_queue()
+        ctx = FakeTransport(failures=[TooManyRequests(), TooManyRequests()])
+        future = queue.enqueue(ctx, "Roll for initiative!")
+        await queue.flush()
+        return ctx, queue, future.result()
+
+    ctx, queue, delivered = asyncio.run(scenario())
+
+    assert delivered is True
+    assert ctx.sent == ["Roll for initiative!"]
+    assert ctx.attempts == 3
+    assert queue.rate_limited == 2
+    assert queue.stats()["rate_limited"] == 2
+
+
+def test_delivery_fails_once_retries_run_out():
+    async def scenario():
+        queue = fast_queue(max_retries=2)
+        ctx = FakeTransport(failures=[TooManyRequests(), TooManyRequests()])
+        future = queue.enqueue(ctx, "Nobody hears this.")
+        later = queue.enqueue(ctx, "But this gets through.")
+        await queue.flush()
+        return ctx, queue, future.result(), later.result()
+
+    ctx, queue, delivered, later_delivered = asyncio.run(scenario())
+
+    assert delivered is False
+    assert queue.rate_limited == 2
+    # The failed message doesn't hold up the rest of the channel.
+    assert later_delivered is True
+    assert ctx.sent == ["But this gets through."]
+
+
+def test_other_errors_are_not_retried():
+    async def scenario():
+        queue = fast_queue()
+        ctx = FakeTransport(failures=[RuntimeError("Missing Permissions")])
+        future = queue.enqueue(ctx, "Hello?")
+        await queue.flush()
+        return ctx, queue, future.result()
+
+    ctx, queue, delivered = asyncio.run(scenario())
+
+    assert delivered is False
+    assert ctx.attempts == 1
+    assert queue.rate_limited == 0
+
+
+def test_rate_limited_exception_is_retried_without_double_counting():
+    async def scenario():
+        queue = fast_queue()
+        ctx = FakeTransport(failures=[discord.RateLimited(0.0)])
+        future = queue.enqueue(ctx, "Eventually.")
+        await queue.flush()
+        return ctx, queue, future.result()
+
+    ctx, queue, delivered = asyncio.run(scenario())
+
+    assert delivered is True
+    assert ctx.sent == ["Eventually."]
+    assert queue.rate_limited == 0
+
+
+def test_429s_handled_inside_discord_py_are_counted_from_its_log():
+    queue = fast_queue()
+    handler = dm.RateLimitLogHandler(queue)
+    logger = logging.getLogger("discord.http")
+    logger.addHandler(handler)
+    try:
+        logger.warning("We are being rate limited. %s %s responded with 429. Retrying in %.2f seconds.", "POST", "https://discord.com/api/v10/channels/1/messages", 0.5)
+        logger.warning("Global rate limit has been hit. Retrying in %.2f seconds.", 0.5)
+        logger.warning("Something unrelated happened.")
+    finally:
+        logger.removeHandler(handler)
+
+    assert queue.rate_limited == 1
+
+
+def test_module_queue_listens_to_the_discord_http_logger():
+    handlers = [handler for handler in logging.getLogger("discord.http").handlers if isinstance(handler, dm.RateLimitLogHandler)]
+
+    assert [handler.queue for handler in handlers] == [dm.outbound_queue]
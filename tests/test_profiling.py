@@ -0,0 +1,50 @@
+import threading
+
+import DungeonMasterGPT as dm
+
+
+def test_sampling_counts_every_call_from_concurrent_threads(monkeypatch):
+    monkeypatch.setattr(dm, "profile_sample_every", 10 ** 6)
+    monkeypatch.setattr(dm, "profile_calls_seen", dm.itertools.count(1))
+
+    def calls():
+        for _ in range(2000):
+            dm.maybe_profiled(lambda: None)
+
+    threads = [threading.Thread(target=calls) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert next(dm.profile_calls_seen) == 8 * 2000 + 1
+
+
+def test_profile_stop_between_check_and_sample_does_not_fail_the_call(monkeypatch):
+    monkeypatch.setattr(dm, "profile_sample_every", 10)
+    monkeypatch.setattr(dm, "profile_samples", 0)
+
+    class StopWhileCounting:
+
+        #Does what !profile stop would if it ran just after maybe_profiled saw profiling was on.
+        def __next__(self):
+            dm.profile_sample_every = 0
+            return 3
+
+    monkeypatch.setattr(dm, "profile_calls_seen", StopWhileCounting())
+
+    assert dm.maybe_profiled(lambda: "reply") == "reply"
+    assert dm.profile_samples == 0
+
+
+def test_one_in_every_n_calls_is_profiled(monkeypatch):
+    monkeypatch.setattr(dm, "profile_sample_every", 5)
+    monkeypatch.setattr(dm, "profile_calls_seen", dm.itertools.count(1))
+    monkeypatch.setattr(dm, "profile_samples", 0)
+    monkeypatch.setattr(dm, "profile_stats", None)
+
+    for _ in range(20):
+        assert dm.maybe_profiled(lambda: sum(range(100))) == 4950
+
+    assert dm.profile_samples == 4
+    assert dm.profile_stats is not None
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import DungeonMasterGPT as dm
+
+
+class CapturingBackend:
+
+    #Stands in for openai.ChatCompletion.create and keeps the messages of every call.
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, model, messages, max_tokens, n, stop, temperature):
+        self.calls.append(messages)
+        return {"choices": [{"message": {"role": "assistant", "content": "The door creaks open."}}], "usage": {"completion_tokens": 4}}
+
+
+def word_tokens(string, encoding_name):
+    return len(string.split())
+
+
+def entry(index):
+    return {"role": "user", "content": f"Player0: Message {index}"}
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    monkeypatch.setattr(dm, "num_tokens_from_string", word_tokens)
+    monkeypatch.setattr(dm, "last_prompt_text", {})
+    monkeypatch.setattr(dm, "prefix_overlaps", dm.collections.deque(maxlen=1000))
+    channel_id = 4000
+    monkeypatch.setitem(dm.campaign_overview, channel_id, "The cult of the old mill")
+    monkeypatch.setitem(dm.progress_summary, channel_id, ["Met the innkeeper", "Found the hidden door"])
+    monkeypatch.setitem(dm.characters, channel_id, {7: (dm.Character("Brom", "Dwarf", "Fighter", "Soldier", "Lawful Good"), "Player0")})
+    monkeypatch.setitem(dm.chat_history, channel_id, [entry(index) for index in range(3)])
+    monkeypatch.setitem(dm.priming_prompt_base, channel_id, dm.default_priming_prompt_base)
+    monkeypatch.setitem(dm.summary_priming_prompt, channel_id, dm.default_summary_priming_prompt)
+    monkeypatch.setitem(dm.temperature, channel_id, 0.8)
+    return channel_id
+
+
+def test_stable_layout_orders_segments_from_least_to_most_changing(channel, monkeypatch):
+    backend = CapturingBackend()
+    monkeypatch.setattr(dm, "completion_backend", backend)
+
+    assert asyncio.run(dm.generate_response("Player0: I open the door", channel)) == "The door creaks open."
+
+    messages = backend.calls[0]
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"].startswith(dm.default_priming_prompt_base)
+    assert messages[0]["content"].endswith("The cult of the old mill")
+    assert messages[1]["content"].startswith("Party details:\nPlayer0: ")
+    assert "Brom" in messages[1]["content"]
+    assert messages[2]["content"].startswith("Campaign progress:")
+    assert messages[3]["content"].startswith("Chat history:")
+    assert messages[4:7] == [entry(index) for index in range(3)]
+    assert messages[7] == {"role": "user", "content": "Player0: I open the door"}
+
+
+def test_progress_is_one_line_per_entry_not_a_list_repr(channel, monkeypatch):
+    backend = CapturingBackend()
+    monkeypatch.setattr(dm, "completion_backend", backend)
+
+    asyncio.run(dm.generate_response("Player0: I open the door", channel))
+
+    progress = backend.calls[0][2]["content"]
+    assert progress.endswith("\n\nMet the innkeeper\nFound the hidden door")
+    assert "['" not in progress
+
+
+def test_summary_prompt_uses_the_same_layout_after_its_own_priming_prompt(channel, monkeypatch):
+    backend = CapturingBackend()
+    monkeypatch.setattr(dm, "completion_backend", backend)
+
+    asyncio.run(dm.generate_response("Have any key events occurred?", channel, is_progress_summary=True))
+
+    messages = backend.calls[0]
+    assert messages[0] == {"role": "system", "content": dm.default_summary_priming_prompt}
+    assert [message["content"].split(":")[0] for message in messages[1:4]] == ["Party details", "Campaign progress", "Chat history"]
+
+
+def test_chunked_trimming_only_drops_whole_chunks(monkeypatch):
+    monkeypatch.setattr(dm, "num_tokens_from_string", word_tokens)
+    history = [entry(index) for index in range(40)]
+
+    # Each entry is 4 "tokens", so 20 entries would fit in 80. Dropping 8 at a time has to go to 24 to get under it.
+    assert dm.truncate_chat_history_chunked(history, 80, chunk_size=8) == history[24:]
+    assert dm.truncate_chat_history_chunked(history, 160, chunk_size=8) == history
+
+
+def test_chunked_window_start_stays_on_chunk_boundaries_as_history_grows(monkeypatch):
+    monkeypatch.setattr(dm, "num_tokens_from_string", word_tokens)
+    chunk = dm.chat_history_trim_chunk
+    history = []
+    starts = []
+    for index in range(100):
+        history.append(entry(index))
+        window = dm.truncate_chat_history_chunked(history, 60)
+        assert sum(word_tokens(f"{item['role']}: {item['content']}", None) for item in window) <= 60
+        starts.append(len(history) - len(window))
+
+    assert all(start % chunk == 0 for start in starts)
+    assert starts == sorted(starts)
+    # The window only moves when a whole chunk drops off the front, so most turns keep the same start and share its prefix.
+    moves = sum(1 for earlier, later in zip(starts, starts[1:]) if later != earlier)
+    assert moves <= len(history) // chunk
+    assert sum(1 for earlier, later in zip(starts, starts[1:]) if later == earlier) > len(history) / 2
+
+
+def test_prefix_overlap_is_the_shared_prefix_over_the_new_prompt(monkeypatch):
+    monkeypatch.setattr(dm, "last_prompt_text", {})
+    monkeypatch.setattr(dm, "prefix_overlaps", dm.collections.deque(maxlen=1000))
+
+    assert dm.record_prefix_overlap(1, False, "abcdef") is None
+    assert dm.record_prefix_overlap(1, False, "abcdxyzw") == pytest.approx(4 / 8)
+    # Progress summary prompts are compared with each other, not with turn prompts.
+    assert dm.record_prefix_overlap(1, True, "abcdxyzw") is None
+    assert dm.record_prefix_overlap(2, False, "abcdxyzw") is None
+    assert dm.record_prefix_overlap(1, False, "abcdxyzw") == 1.0
+    assert list(dm.prefix_overlaps) == [0.5, 1.0]
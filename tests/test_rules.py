@@ -0,0 +1,94 @@
+import asyncio
+import types
+
+import pytest
+
+import DungeonMasterGPT as dm
+
+
+@pytest.fixture
+def index():
+    return dm.RulesIndex({
+        "conditions": {"Prone": "A prone creature's only movement option is to crawl."},
+        "spells": {"Chain Lightning": "Lightning arcs to four targets.", "Fire Bolt": "A mote of fire.", "Fireball": "A bright streak flashes."},
+        "monsters": {"Will-o'-Wisp": "Tiny undead."},
+        "equipment": {"Chain Mail": "Heavy armor.", "Chain Shirt": "Medium armor.", "Thieves' Tools": "Tools for picking locks."},
+    })
+
+
+def names(matches):
+    return [name for name, _, _ in matches]
+
+
+def test_exact_name_is_the_answer(index):
+    matches, exact = index.lookup("fireball")
+
+    assert exact
+    assert names(matches)[0] == "Fireball"
+
+
+def test_apostrophes_are_optional(index):
+    assert dm.normalise_rules_name("Will-o'-Wisp") == "will o wisp"
+    assert index.lookup("thieves tools") == ([("Thieves' Tools", "Equipment", "Tools for picking locks.")], True)
+    assert names(index.lookup("will o wisp")[0]) == ["Will-o'-Wisp"]
+    assert names(index.lookup("thieves’ tools")[0]) == ["Thieves' Tools"]
+
+
+def test_unique_prefix_is_the_answer(index):
+    matches, exact = index.lookup("chain l")
+
+    assert exact
+    assert names(matches)[0] == "Chain Lightning"
+
+
+def test_shared_prefix_is_only_a_suggestion(index):
+    matches, exact = index.lookup("chain")
+
+    assert not exact
+    # Shortest names first, rather than whichever came first in the file.
+    assert names(matches) == ["Chain Mail", "Chain Shirt", "Chain Lightning"]
+    assert not index.lookup("fire")[1]
+
+
+def test_misspelling_is_only_a_suggestion(index):
+    matches, exact = index.lookup("fierball")
+
+    assert not exact
+    assert "Fireball" in names(matches)
+    assert index.lookup("beholder") == ([], False)
+
+
+def test_find_mentions_matches_whole_names_longest_first(index):
+    assert names(index.find_mentions("I cast fireball at the will o wisp")) == ["Will-o'-Wisp", "Fireball"]
+    assert names(index.find_mentions("I pick the lock with my thieves tools")) == ["Thieves' Tools"]
+    assert index.find_mentions("The chain rattles by the fire") == []
+
+
+def test_bundled_srd_answers_common_questions():
+    srd = dm.get_rules_index()
+
+    for query, name in [("counterspell", "Counterspell"), ("shield of faith", "Shield of Faith"), ("greatsword", "Greatsword"), ("thieves tools", "Thieves' Tools")]:
+        matches, exact = srd.lookup(query)
+        assert exact
+        assert names(matches)[0] == name
+
+
+def test_rules_command_replies_with_suggestions_for_a_shared_prefix(index, monkeypatch):
+    monkeypatch.setattr(dm, "rules_index", index)
+    monkeypatch.setattr(dm, "outbound_queue", dm.OutboundQueue(rate=100, per=0.01))
+    sent = []
+
+    async def send(content, file=None):
+        sent.append(content)
+
+    ctx = types.SimpleNamespace(channel=types.SimpleNamespace(id=5000), send=send)
+
+    async def scenario():
+        await dm.rules.callback(ctx, query="chain")
+        await dm.rules.callback(ctx, query="chain mail")
+        await dm.outbound_queue.flush()
+
+    asyncio.run(scenario())
+
+    assert sent[0] == "No exact entry; did you mean Chain Mail (Equipment), Chain Shirt (Equipment), Chain Lightning (Spell)?"
+    assert sent[1].startswith("Chain Mail (Equipment):\nHeavy armor.")
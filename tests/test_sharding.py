@@ -0,0 +1,157 @@
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import benchmark
+import DungeonMasterGPT as dm
+
+
+def crashing_worker(shard_ids, shard_count, budget, log_directory, crashes):
+    #Logs each start, then crashes until it has been started crashes + 1 times.
+    log_path = os.path.join(log_directory, f"starts_{shard_ids[0]}.log")
+    with open(log_path, "a") as f:
+        f.write(f"{time.time()}\n")
+    with open(log_path, "r") as f:
+        starts = len(f.readlines())
+    os._exit(1 if starts <= crashes else 0)
+
+
+def budget_worker(shard_ids, shard_count, budget, in_flight, peak, calls):
+    for _ in range(calls):
+        budget.acquire()
+        try:
+            with in_flight.get_lock():
+                in_flight.value += 1
+                peak.value = max(peak.value, in_flight.value)
+            time.sleep(0.05)
+            with in_flight.get_lock():
+                in_flight.value -= 1
+        finally:
+            budget.release()
+
+
+def dying_budget_worker(shard_ids, shard_count, budget, log_directory, holding):
+    #The first start is killed while holding a budget slot, or the budget lock. The restart only succeeds if the budget recovered.
+    log_path = os.path.join(log_directory, "starts.log")
+    with open(log_path, "a") as f:
+        f.write("start\n")
+    with open(log_path, "r") as f:
+        starts = len(f.readlines())
+    if starts == 1:
+        if holding == "slot":
+            budget.acquire()
+        else:
+            budget.lock.acquire()
+            budget.lock_owner.value = os.getpid()
+        os.kill(os.getpid(), signal.SIGKILL)
+    # Gives up instead of hanging the test if the budget never recovers.
+    threading.Timer(5, os._exit, (0,)).start()
+    budget.acquire()
+    budget.release()
+    with open(os.path.join(log_directory, "recovered"), "w") as f:
+        f.write("ok")
+    os._exit(0)
+
+
+@pytest.mark.parametrize("processes, shard_count", [(1, 1), (2, 2), (2, 5), (3, 8), (4, 16)])
+def test_shard_groups_partition_every_shard_exactly_once(processes, shard_count):
+    groups = dm.shard_groups(processes, shard_count)
+
+    assert len(groups) == processes
+    assert sorted(shard for group in groups for shard in group) == list(range(shard_count))
+    assert max(map(len, groups)) - min(map(len, groups)) <= 1
+
+
+def test_shard_for_guild_matches_discords_formula():
+    assert dm.shard_for_guild(81384788765712384, 4) == (81384788765712384 >> 22) % 4
+    assert [dm.shard_for_guild(benchmark.guild_for_channel(channel_id), 4) for channel_id in range(8)] == [0, 1, 2, 3, 0, 1, 2, 3]
+
+
+def test_fake_gateway_workers_only_play_channels_on_their_shards(tmp_path):
+    args = benchmark.build_parser().parse_args(["--latency", "0", "--threads", "4"])
+    sessions = {1000 + index: benchmark.synthetic_session(2, index) for index in range(8)}
+    budget = dm.OpenAIBudget(max_concurrent=4, calls_per_minute=10 ** 9)
+    worker_target = functools.partial(benchmark.fake_gateway_worker, sessions=sessions, args=args, results_directory=str(tmp_path))
+
+    dm.supervise(2, 4, budget, worker_target=worker_target, restart_delay=0.1, poll_interval=0.05)
+
+    results = []
+    for path in sorted(glob.glob(str(tmp_path / "results_*.json"))):
+        with open(path, "r") as f:
+            results.append(json.load(f))
+    assert [worker["shard_ids"] for worker in results] == [[0, 2], [1, 3]]
+    assert sorted(channel for worker in results for channel in worker["channels"]) == sorted(sessions)
+    for worker in results:
+        assert all(dm.shard_for_guild(benchmark.guild_for_channel(channel), 4) in worker["shard_ids"] for channel in worker["channels"])
+        assert len(worker["latencies"]) == 2 * len(worker["channels"])
+    assert len(benchmark.combine_results(results)["latencies"]) == 16
+
+
+def test_crashed_worker_is_restarted_with_backoff(tmp_path):
+    budget = dm.OpenAIBudget(max_concurrent=1)
+    worker_target = functools.partial(crashing_worker, log_directory=str(tmp_path), crashes=3)
+
+    dm.supervise(1, 1, budget, worker_target=worker_target, restart_delay=0.2, max_restart_delay=0.5, poll_interval=0.02)
+
+    with open(tmp_path / "starts_0.log", "r") as f:
+        starts = [float(line) for line in f]
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    assert len(starts) == 4
+    # Quick crashes double the delay each time, up to max_restart_delay.
+    assert gaps[0] >= 0.2
+    assert gaps[1] >= 0.4
+    assert gaps[2] >= 0.5
+    # Uncapped, the third delay would be 0.8s. Comparing gaps cancels out process start-up time.
+    assert gaps[2] - gaps[1] < 0.3
+
+
+def test_budget_limits_concurrent_calls_across_worker_processes():
+    budget = dm.OpenAIBudget(max_concurrent=2, calls_per_minute=10 ** 9)
+    in_flight = multiprocessing.Value("i", 0)
+    peak = multiprocessing.Value("i", 0)
+    worker_target = functools.partial(budget_worker, in_flight=in_flight, peak=peak, calls=4)
+
+    dm.supervise(4, 4, budget, worker_target=worker_target, poll_interval=0.02)
+
+    assert peak.value == 2
+    assert in_flight.value == 0
+
+
+def test_budget_rate_is_shared_across_processes():
+    budget = dm.OpenAIBudget(max_concurrent=8, calls_per_minute=600)
+    # Start with an empty bucket, so every call below has to wait for the shared refill of 10 calls a second.
+    for _ in range(600):
+        budget.acquire()
+        budget.release()
+    in_flight = multiprocessing.Value("i", 0)
+    peak = multiprocessing.Value("i", 0)
+    processes = [multiprocessing.Process(target=budget_worker, args=([index], 2, budget, in_flight, peak, 5)) for index in range(2)]
+
+    started = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(10)
+    elapsed = time.time() - started
+
+    assert all(process.exitcode == 0 for process in processes)
+    # Separate buckets would let the two processes finish their 5 calls each in about half a second.
+    assert elapsed >= 0.85
+
+
+@pytest.mark.parametrize("holding", ["slot", "lock"])
+def test_budget_recovers_from_a_worker_killed_inside_it(tmp_path, holding):
+    budget = dm.OpenAIBudget(max_concurrent=1, calls_per_minute=10 ** 9, lock_timeout=0.2)
+    worker_target = functools.partial(dying_budget_worker, log_directory=str(tmp_path), holding=holding)
+
+    dm.supervise(1, 1, budget, worker_target=worker_target, restart_delay=0.1, poll_interval=0.02)
+
+    assert (tmp_path / "recovered").exists()
+    assert list(budget.slot_owners) == [0]
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+import DungeonMasterGPT as dm
+
+
+def busy(seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+def test_synchronous_stage_records_cpu(monkeypatch):
+    monkeypatch.setattr(dm, "stage_totals", {})
+    monkeypatch.setattr(dm, "stage_latencies", {})
+
+    with dm.timed_stage("work"):
+        busy(0.05)
+
+    count, wall, cpu = dm.stage_totals["work"]
+    assert count == 1
+    assert wall >= 0.05
+    assert cpu >= 0.04
+
+
+def test_awaiting_stage_is_wall_only_and_ignores_other_coroutines(monkeypatch):
+    monkeypatch.setattr(dm, "stage_totals", {})
+    monkeypatch.setattr(dm, "stage_latencies", {})
+
+    async def waiting_stage():
+        with dm.timed_stage("waiting", cpu=False):
+            await asyncio.sleep(0.1)
+
+    async def neighbour():
+        # Another channel's turn burning CPU on the event loop thread while the stage above is waiting.
+        await asyncio.sleep(0.01)
+        busy(0.05)
+
+    async def scenario():
+        await asyncio.gather(waiting_stage(), neighbour())
+
+    asyncio.run(scenario())
+
+    count, wall, cpu = dm.stage_totals["waiting"]
+    assert count == 1
+    assert wall >= 0.1
+    assert cpu is None
+    assert "dmbot_stage_cpu_seconds_total{stage=\"waiting\"}" not in dm.render_metrics()
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import DungeonMasterGPT as dm
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    monkeypatch.setattr(dm, "SAVE_DATA_DIRECTORY", tmp_path)
+    monkeypatch.setattr(dm, "warm_snapshot_name", "warm_snapshot.json")
+    for name in ("campaign_overview", "progress_summary", "characters", "chat_history", "priming_prompt_base", "summary_priming_prompt", "last_active"):
+        monkeypatch.setattr(dm, name, {})
+    monkeypatch.setattr(dm, "dirty_channels", set())
+    return tmp_path
+
+
+def start_channel(channel_id, overview):
+    dm.campaign_overview[channel_id] = overview
+    dm.progress_summary[channel_id] = ["Met the innkeeper"]
+    dm.characters[channel_id] = {}
+    dm.chat_history[channel_id] = [{"role": "user", "content": "Player0: Hello"}]
+    dm.priming_prompt_base[channel_id] = dm.default_priming_prompt_base
+    dm.summary_priming_prompt[channel_id] = dm.default_summary_priming_prompt
+    dm.last_active[channel_id] = time.time()
+
+
+def forget_everything():
+    for mapping in (dm.campaign_overview, dm.progress_summary, dm.characters, dm.chat_history, dm.priming_prompt_base, dm.summary_priming_prompt, dm.last_active):
+        mapping.clear()
+
+
+def test_snapshot_round_trip(state):
+    start_channel(1, "The cult of the old mill")
+    dm.save_data(1)
+    dm.write_warm_snapshot()
+    forget_everything()
+
+    dm.load_warm_snapshot()
+
+    assert dm.campaign_overview[1] == "The cult of the old mill"
+    assert dm.chat_history[1] == [{"role": "user", "content": "Player0: Hello"}]
+    assert not (state / "warm_snapshot.json").exists()
+
+
+def test_snapshot_older_than_max_age_is_ignored(state):
+    start_channel(1, "Stale")
+    dm.write_warm_snapshot()
+    snapshot_file = state / "warm_snapshot.json"
+    with open(snapshot_file, "r") as f:
+        snapshot = json.load(f)
+    snapshot["written_at"] -= dm.WARM_SNAPSHOT_MAX_AGE + 1
+    with open(snapshot_file, "w") as f:
+        json.dump(snapshot, f)
+    forget_everything()
+
+    dm.load_warm_snapshot()
+
+    assert 1 not in dm.campaign_overview
+    assert not snapshot_file.exists()
+
+
+def test_channel_saved_after_the_snapshot_is_not_overwritten(state):
+    start_channel(1, "Old overview")
+    start_channel(2, "Untouched since the snapshot")
+    dm.save_data(1)
+    dm.save_data(2)
+    dm.write_warm_snapshot()
+    # Channel 1 is saved again later, e.g. by a process using a different snapshot file.
+    dm.campaign_overview[1] = "Newer overview"
+    dm.save_data(1)
+    later = time.time() + 5
+    os.utime(dm.get_data_file(1), (later, later))
+    forget_everything()
+
+    dm.load_warm_snapshot()
+
+    assert 1 not in dm.campaign_overview
+    dm.ensure_channel_loaded(1)
+    assert dm.campaign_overview[1] == "Newer overview"
+    assert dm.campaign_overview[2] == "Untouched since the snapshot"
+
+
+def test_channels_only_loaded_from_a_snapshot_are_not_carried_into_the_next(state):
+    start_channel(1, "Played before the restart")
+    dm.save_data(1)
+    dm.write_warm_snapshot()
+    forget_everything()
+    dm.load_warm_snapshot()
+
+    start_channel(2, "Played after the restart")
+    dm.write_warm_snapshot()
+
+    with open(state / "warm_snapshot.json", "r") as f:
+        snapshot = json.load(f)
+    assert list(snapshot["channels"]) == ["2"]
+    assert 1 not in dm.last_active
+
+
+def test_graceful_shutdown_saves_first_and_keeps_to_one_deadline(state, monkeypatch):
+    monkeypatch.setattr(dm, "SHUTDOWN_TIMEOUT", 0.3)
+    monkeypatch.setattr(dm, "shutting_down", False)
+    monkeypatch.setattr(dm, "in_flight_turns", set())
+    monkeypatch.setattr(dm, "outbound_queue", dm.OutboundQueue())
+    closed = []
+
+    async def close():
+        closed.append(time.monotonic())
+
+    monkeypatch.setattr(dm, "bot", type("FakeBot", (), {"close": staticmethod(close)})())
+    start_channel(1, "Saved before the hung turn")
+    dm.dirty_channels.add(1)
+
+    async def hung_turn():
+        await asyncio.sleep(60)
+
+    class StuckTransport:
+        channel = type("Channel", (), {"id": 1})()
+
+        async def send(self, content, file=None):
+            await asyncio.sleep(60)
+
+    async def scenario():
+        turn = asyncio.create_task(hung_turn())
+        dm.in_flight_turns.add(turn)
+        dm.outbound_queue.enqueue(StuckTransport(), "Never delivered")
+        shutdown = asyncio.create_task(dm.graceful_shutdown())
+        await asyncio.sleep(0.05)
+        saved_before_draining = dm.get_data_file(1).exists()
+        started = time.monotonic()
+        await shutdown
+        turn.cancel()
+        return saved_before_draining, time.monotonic() - started
+
+    saved_before_draining, waited = asyncio.run(scenario())
+
+    assert saved_before_draining
+    # The turn wait and the queue flush share the 0.3s deadline instead of taking 0.3s each.
+    assert waited < 0.5
+    assert closed
+    assert (state / "warm_snapshot.json").exists()
+
+
+def test_character_created_in_an_unloaded_channel_is_flushed(state, monkeypatch):
+    monkeypatch.setattr(dm, "outbound_queue", dm.OutboundQueue(rate=100, per=0.01))
+
+    class FakeContext:
+        channel = type("Channel", (), {"id": 7})()
+        author = type("Author", (), {"id": 70, "name": "Player0"})()
+
+        async def send(self, content, file=None):
+            pass
+
+    async def scenario():
+        ctx = FakeContext()
+        # The same hooks the bot runs around every command.
+        await dm.load_channel_for_command(ctx)
+        await dm.create_character.callback(ctx, args="Brom, Dwarf, Fighter, Soldier, Lawful Good")
+        await dm.mark_channel_dirty(ctx)
+        await dm.outbound_queue.flush()
+
+    asyncio.run(scenario())
+    dm.flush_dirty_channels()
+
+    assert dm.bot._before_invoke is dm.load_channel_for_command
+    assert not dm.dirty_channels
+    with open(dm.get_data_file(7), "r") as f:
+        saved = json.load(f)
+    assert saved["characters"]["70"]["character"]["name"] == "Brom"